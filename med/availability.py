@@ -0,0 +1,111 @@
+from bisect import bisect_left, bisect_right
+
+from django.db.models import Q
+from psycopg2.extras import DateTimeTZRange, NumericRange
+
+from organizer.models import RecordServiceMedPersona, medpersona_range
+from .models import ServiceMedPersona, TimeSlot, ScheduleRule
+from .schedule import get_slot_duration, occurrences
+
+
+class IntervalSet:
+    """
+    Множество занятых интервалов [start, end). При построении интервалы
+    сортируются и сливаются, после чего пересечение с любым отрезком
+    проверяется двоичным поиском за O(log n).
+    """
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlaps(self, start, end):
+        # Первый интервал, который заканчивается позже start. Интервалы не
+        # пересекаются, поэтому их концы тоже отсортированы.
+        i = bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+
+def free_slots(slot_starts, duration, busy, window_start, window_end):
+    """
+    Возвращает начала слотов из отсортированного списка slot_starts, которые
+    целиком попадают в окно [window_start, window_end) и не пересекаются с
+    занятыми интервалами busy.
+    """
+    first = bisect_left(slot_starts, window_start)
+    last = bisect_right(slot_starts, window_end - duration)
+    return [start for start in slot_starts[first:last] if not busy.overlaps(start, start + duration)]
+
+
+def get_medic_bookings(medpersona_id, window_start, window_end):
+    """
+    Занятые интервалы медперсоны, пересекающие окно. Условие совпадает с
+    выражениями GiST индекса ограничения record_medpersona_no_overlap,
+    поэтому читаются только записи окна, а не вся история медперсоны.
+    """
+    periods = RecordServiceMedPersona.objects.annotate(
+        medpersona_range=medpersona_range(),
+    ).filter(
+        medpersona_range__overlap=NumericRange(medpersona_id, medpersona_id, '[]'),
+        period__overlap=DateTimeTZRange(window_start, window_end, '[)'),
+    ).values_list('period', flat=True)
+    return IntervalSet((period.lower, period.upper) for period in periods)
+
+
+def get_availability(medpersona_id, window_start, window_end, service_id=None):
+    """
+    Свободные слоты медперсоны в окне по всем услугам, которые она
+    оказывает (или по одной service_id). Слоты услуги берутся из ее
+    расписания (TimeSlot) и правил ScheduleRule, занятость - из записей на
+    медперсону по любой услуге. Слоты и записи выбираются только в пределах окна, поэтому
+    стоимость не зависит от длины расписания и истории записей.
+    """
+    services = ServiceMedPersona.objects.filter(medpersona_id=medpersona_id)
+    if service_id is not None:
+        services = services.filter(service_id=service_id)
+
+    duration = get_slot_duration()
+    # Слоты окна выбираются по индексу (timetable, starts_at); у услуги
+    # не больше одного расписания
+    rows = TimeSlot.objects.filter(
+        timetable__service_id__in=services.values('service_id'),
+        starts_at__gte=window_start,
+        starts_at__lte=window_end - duration,
+    ).order_by('starts_at').values_list('timetable__service_id', 'starts_at')
+
+    timetables = {}
+    for service, starts_at in rows:
+        timetables.setdefault(service, set()).add(starts_at)
+
+    # Слоты повторяющихся правил услуги (общих и этой медперсоны)
+    # разворачиваются только для дней окна
+    rules = ScheduleRule.objects.filter(
+        Q(medpersona__isnull=True) | Q(medpersona_id=medpersona_id),
+        Q(valid_until__isnull=True) | Q(valid_until__gte=window_start.date()),
+        service_id__in=services.values('service_id'),
+        valid_from__lte=window_end.date(),
+    )
+    for rule in rules:
+        timetables.setdefault(rule.service_id, set()).update(occurrences(rule, window_start, window_end))
+
+    if not timetables:
+        return []
+
+    busy = get_medic_bookings(medpersona_id, window_start, window_end)
+
+    slots = [
+        {'service': service, 'start': start, 'end': start + duration}
+        for service, dates in timetables.items()
+        for start in free_slots(sorted(dates), duration, busy, window_start, window_end)
+    ]
+    slots.sort(key=lambda slot: (slot['start'], slot['service']))
+    return slots
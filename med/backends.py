@@ -1,9 +1,55 @@
 import jwt
+from .cache import user_cache, token_state_cache
 from .models import UserProfile
 from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 from rest_framework import authentication, exceptions
 
 
+class ClaimsUser(SimpleLazyObject):
+    """
+    Пользователь, построенный по подписанным claims токена. Идентификатор,
+    роль и флаг активности берутся из токена, поэтому проверки прав не
+    обращаются к базе. При обращении к любому другому атрибуту пользователь
+    загружается из базы (через кэш) и дальше объект ведет себя как UserProfile.
+    """
+
+    def __init__(self, payload, loader):
+        super().__init__(lambda: loader(payload['id']))
+        self.__dict__['_claims'] = payload
+
+    @property
+    def pk(self):
+        return self._claims['id']
+
+    @property
+    def id(self):
+        return self._claims['id']
+
+    @property
+    def role(self):
+        return self._claims['role']
+
+    @property
+    def is_active(self):
+        return self._claims['active']
+
+    @property
+    def token_version(self):
+        return self._claims['ver']
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def __bool__(self):
+        return True
+
+
 class JWTAuthentication(authentication.BaseAuthentication):
     authentication_header_prefix = 'bearer'
 
@@ -69,9 +115,16 @@ class JWTAuthentication(authentication.BaseAuthentication):
             msg = 'Ошибка аутентификации. Невозможно декодировать токен'
             raise exceptions.AuthenticationFailed(msg)
 
-        try:
-            user = UserProfile.objects.get(pk=payload['id'])
-        except UserProfile.DoesNotExist:
+        if payload.get('type') == 'refresh':
+            # Refresh токен годится только для получения нового токена доступа
+            msg = 'Ошибка аутентификации. Передан refresh токен'
+            raise exceptions.AuthenticationFailed(msg)
+
+        if 'role' in payload:
+            return self.authenticate_claims(payload, token)
+
+        user = self.get_user(payload['id'])
+        if user is None:
             msg = 'Пользователь соответствующий данному токену не найден.'
             raise exceptions.AuthenticationFailed(msg)
 
@@ -80,3 +133,60 @@ class JWTAuthentication(authentication.BaseAuthentication):
             raise exceptions.AuthenticationFailed(msg)
 
         return (user, token)
+
+    def authenticate_claims(self, payload, token):
+        """
+        Аутентификация по подписанным claims. Сверяется только версия токена:
+        если роль или активность пользователя изменились, версия в базе
+        увеличена и старый токен отклоняется.
+        """
+        state = self.get_token_state(payload['id'])
+        if state is None:
+            msg = 'Пользователь соответствующий данному токену не найден.'
+            raise exceptions.AuthenticationFailed(msg)
+
+        token_version, is_active = state
+        if payload.get('ver') != token_version:
+            msg = 'Токен отозван. Необходимо войти заново.'
+            raise exceptions.AuthenticationFailed(msg)
+
+        if not is_active or not payload.get('active'):
+            msg = 'Данный пользователь деактивирован.'
+            raise exceptions.AuthenticationFailed(msg)
+
+        return (ClaimsUser(payload, self.get_user), token)
+
+    def get_token_state(self, user_id):
+        """
+        Возвращает пару (версия токена, активность) пользователя. Значение
+        кэшируется так же, как и сам пользователь.
+        """
+        state = token_state_cache.get(user_id)
+        if state is not None:
+            return state
+
+        state = UserProfile.objects.filter(pk=user_id).values_list('token_version', 'is_active').first()
+        if state is None:
+            return None
+
+        token_state_cache.set(user_id, state)
+        return state
+
+    def get_user(self, user_id):
+        """
+        Возвращает пользователя по идентификатору из токена. Снимок
+        пользователя хранится в процессном кэше, поэтому обращение к базе
+        происходит только при промахе. Кэш сбрасывается сигналами сохранения и
+        удаления UserProfile (см. med/signal.py).
+        """
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+
+        try:
+            user = UserProfile.objects.get(pk=user_id)
+        except UserProfile.DoesNotExist:
+            return None
+
+        user_cache.set(user_id, user)
+        return user
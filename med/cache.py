@@ -0,0 +1,86 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class TTLCache:
+    """
+    Процессный кэш с ограничением по времени жизни записей и по размеру.
+    При переполнении вытесняются записи, к которым дольше всего не обращались.
+    Кэш потокобезопасен, так как waitress обслуживает запросы в нескольких
+    потоках одного процесса.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class UserCache(TTLCache):
+    """
+    Кэш снимков пользователей для аутентификации по JWT. Каждый запрос
+    получает собственную копию объекта, чтобы изменения request.user в одном
+    потоке не попадали в другие.
+    """
+
+    def get(self, key):
+        user = super().get(key)
+        if user is None:
+            return None
+        return copy.copy(user)
+
+    def set(self, key, value):
+        super().set(key, copy.copy(value))
+
+
+user_cache = UserCache(
+    ttl=getattr(settings, 'JWT_USER_CACHE_TTL', 60),
+    max_size=getattr(settings, 'JWT_USER_CACHE_MAX_SIZE', 10000),
+)
+
+# Текущие версия токенов и флаг активности пользователей. Нужны для проверки
+# токенов с подписанными claims без загрузки всего пользователя.
+token_state_cache = TTLCache(
+    ttl=getattr(settings, 'JWT_USER_CACHE_TTL', 60),
+    max_size=getattr(settings, 'JWT_USER_CACHE_MAX_SIZE', 10000),
+)
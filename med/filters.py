@@ -6,12 +6,10 @@ class TimetableFilter(filters.FilterSet):
     service = filters.NumberFilter(field_name='service_field', method='filter_service')
 
     def filter_service(self, queryset, name, value):
-
-        try:
-            service = Service.objects.get(pk=value)
-            return queryset.filter(service=service)
-        except Service.DoesNotExist:
-            return queryset.none()
+        # Отдельная проверка существования услуги не нужна: для
+        # несуществующей услуги условие по индексу service_id даст пустой
+        # результат тем же запросом.
+        return queryset.filter(service_id=value)
 
     class Meta:
         model = TimeTable
@@ -28,23 +26,7 @@ class ServiceMedPersonaFilter(filters.FilterSet):
     );
 
     def filter_service_type(self, queryset, name, value):
-        service_queryset = None
-
-        if value == 'Procedure':
-            service_queryset = Procedure.objects.all()
-        elif value == 'Event':
-            service_queryset = Event.objects.all()
-        elif value == 'Survey':
-            service_queryset = Survey.objects.all()
-        elif value == 'Speciality':
-            service_queryset = Speciality.objects.all()
-
-        try:
-            service_id_list = service_queryset.values_list('service__id', flat=True)
-        except:
-            return queryset.none()
-        else:
-            return queryset.filter(service__id__in=service_id_list)
+        return queryset.filter(service__service_type=value)
 
     class Meta:
         model = ServiceMedPersona
@@ -61,23 +43,7 @@ class ServiceFilter(filters.FilterSet):
     );
 
     def filter_service_type(self, queryset, name, value):
-        service_queryset = None
-
-        if value == 'Procedure':
-            service_queryset = Procedure.objects.all()
-        elif value == 'Event':
-            service_queryset = Event.objects.all()
-        elif value == 'Survey':
-            service_queryset = Survey.objects.all()
-        elif value == 'Speciality':
-            service_queryset = Speciality.objects.all()
-
-        try:
-            service_id_list = service_queryset.values_list('service__id', flat=True)
-        except:
-            return queryset.none()
-        else:
-            return queryset.filter(id__in=service_id_list)
+        return queryset.filter(service_type=value)
 
     class Meta:
         model = Service
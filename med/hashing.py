@@ -0,0 +1,109 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.hashers import check_password, make_password
+from rest_framework import exceptions, status
+
+
+class HashingPoolBusy(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Сервер перегружен, повторите попытку позже.'
+    default_code = 'service_unavailable'
+
+
+class HashingPool:
+    """
+    Ограниченный пул потоков для хеширования паролей. Хеширование занимает
+    десятки миллисекунд процессорного времени, поэтому одновременно
+    выполняется не более `workers` задач, а всего (вместе с ожидающими) в
+    пуле может быть не более `max_pending`. Лишний запрос сразу получает 503.
+
+    Поток waitress ждет результат хеширования, поэтому `max_pending` должен
+    быть меньше числа потоков сервера (SERVER_THREADS): иначе потоки
+    сервера закончатся раньше, чем заполнится пул, и 503 не будет никогда.
+    """
+
+    def __init__(self, workers, max_pending, timeout, server_threads=None):
+        if max_pending < workers:
+            raise ImproperlyConfigured('PASSWORD_HASHING_MAX_PENDING меньше числа потоков хеширования')
+        if server_threads is not None and max_pending >= server_threads:
+            raise ImproperlyConfigured('PASSWORD_HASHING_MAX_PENDING должен быть меньше SERVER_THREADS')
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hashing')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HashingPoolBusy()
+
+        with self._lock:
+            self._pending += 1
+            self._submitted += 1
+        return self._executor.submit(self._call, fn, *args, **kwargs)
+
+    def run(self, fn, *args, **kwargs):
+        """ Выполняет fn в пуле и ждет результат в текущем потоке. """
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingPoolBusy()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'running': self._running,
+                'queue_depth': self._pending - self._running,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'rejected': self._rejected,
+            }
+
+    def _call(self, fn, *args, **kwargs):
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._pending -= 1
+                self._completed += 1
+            self._slots.release()
+
+
+hashing_pool = HashingPool(
+    workers=getattr(settings, 'PASSWORD_HASHING_WORKERS', 2),
+    max_pending=getattr(settings, 'PASSWORD_HASHING_MAX_PENDING', 4),
+    timeout=getattr(settings, 'PASSWORD_HASHING_TIMEOUT', 5),
+    server_threads=getattr(settings, 'SERVER_THREADS', None),
+)
+
+
+def hash_password(password):
+    """ Аналог make_password, выполняемый в пуле хеширования. """
+    return hashing_pool.run(make_password, password)
+
+
+def verify_password(password, encoded):
+    """
+    Аналог check_password, выполняемый в пуле хеширования. Возвращает пару
+    (пароль верен, хеш нужно пересчитать текущим алгоритмом).
+    """
+    updates = []
+    is_correct = hashing_pool.run(check_password, password, encoded, updates.append)
+    return is_correct, bool(updates)
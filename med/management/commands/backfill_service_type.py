@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from med.models import Service
+from med.versioning import bump_version
+
+
+class Command(BaseCommand):
+    help = 'Заполняет Service.service_type по таблицам Procedure, Event, Survey и Speciality'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество услуг в одной транзакции')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ids = list(Service.objects.order_by('pk').values_list('pk', flat=True))
+
+        # Обновляем порциями, чтобы не держать блокировку на всей таблице
+        updated = 0
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                updated += Service.objects.sync_service_type(ids[start:start + batch_size])
+
+        bump_version(Service)
+        self.stdout.write('Обновлено услуг: %d' % updated)
@@ -0,0 +1,54 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from med.models import Patient
+from med.renderers import FastJSONRenderer, orjson
+from med.serializers import PatientSerializer
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает время кодирования JSON стандартным и быстрым рендерером'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Количество пациентов в ответе')
+        parser.add_argument('--repeat', type=int, default=10, help='Количество повторов')
+
+    def handle(self, *args, **options):
+        # Пациенты не сохраняются в базу: измеряется только кодирование
+        # уже сериализованных данных, как в JSONRenderer.render
+        now = timezone.now()
+        patients = [
+            Patient(
+                id=i + 1,
+                user_id=i + 1,
+                birth_date=date(1980, 1, 1),
+                gender='Male',
+                region='Регион %d' % i,
+                city='Город %d' % i,
+                receipt_date=now,
+                type='Treating',
+                group=['Diabetic', 'Группа %d' % (i % 10)],
+                complaints='Жалобы пациента %d ' % i * 5,
+            )
+            for i in range(options['rows'])
+        ]
+        data = PatientSerializer(patients, many=True).data
+
+        renderers = [
+            ('JSONRenderer', JSONRenderer()),
+            ('FastJSONRenderer (%s)' % ('orjson' if orjson is not None else 'json'), FastJSONRenderer()),
+        ]
+        for name, renderer in renderers:
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                content = renderer.render(data)
+                timings.append(time.perf_counter() - start)
+
+            self.stdout.write('%-28s best %8.2f ms  avg %8.2f ms  %d bytes' % (
+                name, min(timings) * 1000, sum(timings) / len(timings) * 1000, len(content)
+            ))
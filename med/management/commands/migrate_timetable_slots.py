@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from med.models import TimeTable, TimeSlot
+from med.versioning import bump_version
+
+
+class Command(BaseCommand):
+    help = 'Переносит слоты из массива TimeTable.dates в таблицу TimeSlot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Количество расписаний в одной транзакции')
+        parser.add_argument('--clear', action='store_true', help='Очистить массив dates после переноса')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ids = list(TimeTable.objects.filter(dates__isnull=False).order_by('pk').values_list('pk', flat=True))
+
+        created = 0
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                timetables = TimeTable.objects.filter(pk__in=ids[start:start + batch_size]).select_for_update()
+                slots = [
+                    TimeSlot(timetable=timetable, starts_at=starts_at)
+                    for timetable in timetables
+                    for starts_at in set(timetable.dates or [])
+                ]
+                # Повторный запуск безопасен: уже перенесенные слоты пропускаются
+                created += len(TimeSlot.objects.bulk_create(slots, ignore_conflicts=True))
+                if options['clear']:
+                    timetables.update(dates=None)
+
+        bump_version(TimeTable)
+        self.stdout.write('Перенесено расписаний: %d, слотов: %d' % (len(ids), created))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from med.models import NotificationCounter
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики непрочитанных уведомлений по таблице уведомлений'
+
+    def handle(self, *args, **options):
+        updated = NotificationCounter.objects.rebuild()
+        self.stdout.write('Обновлено счетчиков: %d' % updated)
@@ -1,10 +1,12 @@
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.core import validators
 from django.utils import timezone
 
 import jwt
+import uuid
 
 from datetime import datetime, timedelta, date
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.contrib.postgres.fields import ArrayField
 from django.conf import settings
 from django.contrib.auth.models import (
@@ -12,6 +14,8 @@ from django.contrib.auth.models import (
 )
 from django.core.validators import RegexValidator
 
+from .hashing import hash_password
+
 ROLES_CHOICES = [('Admin', 'Админ'), ('Doctor', 'Врач'), ('Patient', 'Пациент')]
 MENU_CHOICES = [('Breakfast', 'Завтрак'), ('Lunch', 'Обед'), ('Dinner', 'Обед')]
 GENDER_CHOICES = [('Male', 'Мужской'), ('Female', 'Женский')]
@@ -19,6 +23,8 @@ PATIENT_STATUS_CHOICES = [('Accept', 'Принят'), ('Discharged', 'Выпис
 PATIENT_TYPE_CHOICES = [('Vacationer', 'Отдыхающий'), ('Treating', 'Лечащийся'), ('Discharged', 'Выписан')]
 # PATIENT_GROUP_CHOICES = [('Diabetic', 'Диабетик')]  # стоит дополнить
 NOTIFICATION_STATUS_CHOICES = [('Sended', 'Отправлена'), ('Not Sended', 'Не отправлена')]
+# Уведомления с этим статусом учитываются в счетчике непрочитанных
+NOTIFICATION_UNREAD_STATUS = 'Not Sended'
 TASK_STATUS_CHOICES = [('Done', 'Сделана'), ('Not done', 'Не сделана')]
 NOTIFICATION_SEND_TIME = [('5', 5), ('10', 10), ('30', 30), ('60', 60)]
 RECOMMENDATION_CHOICES = [('Mandatory', 'Обязательный'), ('Permissive', 'Необязательный')]
@@ -49,7 +55,8 @@ class UserManager(BaseUserManager):
                           password=password, photo=photo)
         if not password:
             user.set_password(self.cleaned_data["password"])
-        user.set_password(password)
+        # Хеширование выполняется в ограниченном пуле, см. med/hashing.py
+        user.password = hash_password(password)
         user.save()
 
         return user
@@ -133,6 +140,12 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
 
     phone_number = models.CharField(max_length=18, blank=True)
 
+    # Версия токенов пользователя. Увеличивается при смене роли, пароля или
+    # деактивации, после чего ранее выданные токены перестают приниматься.
+    token_version = models.PositiveIntegerField(verbose_name='Версия токена', default=0)
+    # Поля, при изменении которых отзываются ранее выданные токены
+    TOKEN_FIELDS = ('role', 'is_active', 'password')
+
     # Свойство USERNAME_FIELD сообщает нам, какое поле мы будем использовать
     # для входа в систему. В данном случае мы хотим использовать почту.
     USERNAME_FIELD = 'email'
@@ -146,6 +159,21 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
 
+    def save(self, *args, **kwargs):
+        # Роль и флаг активности хранятся в токене, поэтому при их изменении
+        # (как и при смене пароля) все ранее выданные токены пользователя
+        # должны стать недействительными. При сохранении части полей версия
+        # токена дописывается в update_fields.
+        update_fields = kwargs.get('update_fields')
+        fields = [field for field in self.TOKEN_FIELDS if update_fields is None or field in update_fields]
+        if self.pk is not None and fields:
+            previous = UserProfile.objects.filter(pk=self.pk).values(*fields).first()
+            if previous is not None and any(previous[field] != getattr(self, field) for field in fields):
+                self.token_version += 1
+                if update_fields is not None and 'token_version' not in update_fields:
+                    kwargs['update_fields'] = list(update_fields) + ['token_version']
+        super().save(*args, **kwargs)
+
     def __str__(self):
         """ Строковое представление модели (отображается в консоли) """
         return self.email
@@ -185,21 +213,112 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
     def _generate_jwt_token(self):
         """
         Генерирует веб-токен JSON, в котором хранится идентификатор этого
-        пользователя, срок действия токена составляет 1 день от создания
+        пользователя. Это короткоживущий токен доступа, срок его действия
+        задается JWT_ACCESS_TOKEN_LIFETIME, продлевается он refresh токеном.
+        В режиме JWT_SIGNED_CLAIMS в токен также попадают роль, флаг
+        активности и версия токена, чтобы проверка прав не требовала
+        загрузки пользователя из базы.
         """
 
-        dt = datetime.now() + timedelta(days=30)
+        dt = datetime.now() + getattr(settings, 'JWT_ACCESS_TOKEN_LIFETIME', timedelta(minutes=30))
 
-        token = jwt.encode({
+        payload = {
             'id': self.pk,
             'exp': dt.utcfromtimestamp(dt.timestamp())
-        }, settings.SECRET_KEY, algorithm='HS256')
+        }
+        if getattr(settings, 'JWT_SIGNED_CLAIMS', False):
+            payload.update({
+                'role': self.role,
+                'active': self.is_active,
+                'ver': self.token_version,
+            })
+
+        token = jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
 
         return token.encode().decode('utf-8')
 
 
+class RefreshTokenManager(models.Manager):
+    def issue(self, user):
+        """ Создает запись о refresh токене и возвращает сам токен. """
+        now = timezone.now()
+        expires_at = now + getattr(settings, 'JWT_REFRESH_TOKEN_LIFETIME', timedelta(days=30))
+        jti = uuid.uuid4().hex
+
+        # Истекшие токены пользователя больше не нужны даже для обнаружения
+        # повторного использования, поэтому таблица чистится при выдаче.
+        self.filter(user=user, expires_at__lt=now).delete()
+        self.create(jti=jti, user=user, expires_at=expires_at)
+
+        token = jwt.encode({
+            'type': 'refresh',
+            'jti': jti,
+            'id': user.pk,
+            # Как и у токена доступа: после смены пароля, роли или
+            # деактивации refresh токен перестает приниматься
+            'ver': user.token_version,
+            'exp': expires_at,
+        }, settings.SECRET_KEY, algorithm='HS256')
+
+        return token
+
+    def revoke_user(self, user_id):
+        """ Отзывает все refresh токены пользователя. """
+        return self.filter(user_id=user_id, revoked=False).update(revoked=True)
+
+
+class RefreshToken(models.Model):
+    # Храним только идентификатор токена (jti), сам токен подписан и
+    # проверяется без обращения к базе.
+    jti = models.CharField(verbose_name='Идентификатор', max_length=32, unique=True)
+    user = models.ForeignKey(UserProfile, verbose_name='Пользователь', on_delete=models.CASCADE,
+                             related_name='refresh_tokens')
+    expires_at = models.DateTimeField(verbose_name='Истекает')
+    revoked = models.BooleanField(verbose_name='Отозван', default=False)
+
+    objects = RefreshTokenManager()
+
+    class Meta:
+        verbose_name = 'Refresh токен'
+        verbose_name_plural = 'Refresh токены'
+
+
 # Восстановление доступа????
 
+class NotificationManager(models.Manager):
+    def insert_new(self, notifications, batch_size=500):
+        """
+        Вставляет уведомления, пропуская уже существующие по dedup_key, и
+        возвращает только вставленные этим вызовом. В отличие от
+        bulk_create(ignore_conflicts=True) параллельный вызов с теми же
+        ключами не получит чужие строки как свои.
+        Сигналы и Notification.save при этом не вызываются.
+        """
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        by_key = {notification.dedup_key: notification for notification in notifications}
+
+        created = []
+        for start in range(0, len(notifications), batch_size):
+            batch = notifications[start:start + batch_size]
+            params = [field.get_db_prep_save(field.pre_save(notification, True), connection)
+                      for notification in batch for field in fields]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO {table} ({columns}) VALUES {rows} ON CONFLICT DO NOTHING '
+                    'RETURNING id, dedup_key'.format(table=table, columns=columns, rows=', '.join([row] * len(batch))),
+                    params,
+                )
+                for pk, dedup_key in cursor.fetchall():
+                    notification = by_key[dedup_key]
+                    notification.pk = pk
+                    notification._state.adding = False
+                    created.append(notification)
+        return created
+
+
 class Notification(models.Model):
     user = models.ForeignKey(UserProfile, verbose_name='Пользователь', on_delete=models.CASCADE)
     # тип
@@ -208,11 +327,91 @@ class Notification(models.Model):
     source = models.CharField(verbose_name='Источник', max_length=50)
     date_of_sending = models.DateField(verbose_name='Дата отправки', blank=True, default=timezone.now)
     status = models.CharField(verbose_name='Статус', max_length=50, choices=NOTIFICATION_STATUS_CHOICES)
+    # Ключ автоматического уведомления (запись, пользователь, упреждение):
+    # повторная постановка того же уведомления игнорируется
+    dedup_key = models.CharField(verbose_name='Ключ', max_length=100, unique=True, null=True, blank=True,
+                                 editable=False)
+
+    objects = NotificationManager()
 
     class Meta:
         verbose_name = 'Уведомление'
         verbose_name_plural = 'Уведомления'
 
+    def save(self, *args, **kwargs):
+        # Счетчик непрочитанных меняется в той же транзакции, что и уведомление
+        with transaction.atomic():
+            deltas = {}
+            if not self._state.adding:
+                previous = Notification.objects.select_for_update().filter(pk=self.pk).values_list(
+                    'user_id', 'status').first()
+                if previous is not None and previous[1] == NOTIFICATION_UNREAD_STATUS:
+                    deltas[previous[0]] = -1
+            super().save(*args, **kwargs)
+            if self.status == NOTIFICATION_UNREAD_STATUS:
+                deltas[self.user_id] = deltas.get(self.user_id, 0) + 1
+            NotificationCounter.objects.add(deltas)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            if self.status == NOTIFICATION_UNREAD_STATUS:
+                NotificationCounter.objects.add({self.user_id: -1})
+        return result
+
+
+class NotificationCounterManager(models.Manager):
+    def add(self, deltas):
+        """
+        Изменяет счетчики пользователей на {user_id: delta} одним запросом.
+        Отсутствующие строки создаются, поэтому одновременные изменения
+        счетчика одного пользователя не теряются.
+        """
+        deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+        if deltas:
+            self._upsert(deltas, 'unread = {table}.unread + EXCLUDED.unread')
+
+    def rebuild(self):
+        """
+        Пересчитывает все счетчики по таблице уведомлений. На время
+        пересчета запись уведомлений блокируется, чтобы изменения не
+        потерялись между подсчетом и записью счетчиков.
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE %s IN SHARE MODE' % connection.ops.quote_name(Notification._meta.db_table))
+            counts = dict(Notification.objects.filter(status=NOTIFICATION_UNREAD_STATUS).order_by().values(
+                'user_id').annotate(count=models.Count('pk')).values_list('user_id', 'count'))
+            reset = self.exclude(user_id__in=counts.keys()).exclude(unread=0).update(unread=0)
+            if counts:
+                self._upsert(counts, 'unread = EXCLUDED.unread')
+        return len(counts) + reset
+
+    def _upsert(self, values, assignment):
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} (user_id, unread) SELECT * FROM unnest(%s::bigint[], %s::integer[]) '
+                'ON CONFLICT (user_id) DO UPDATE SET {assignment}'.format(
+                    table=table, assignment=assignment.format(table=table)),
+                [list(values.keys()), list(values.values())],
+            )
+
+
+class NotificationCounter(models.Model):
+    # Количество непрочитанных уведомлений пользователя. Поддерживается
+    # Notification.save/delete, после массовых изменений в обход модели
+    # пересчитывается командой rebuild_notification_counters.
+    user = models.OneToOneField(UserProfile, verbose_name='Пользователь', primary_key=True,
+                                related_name='notification_counter', on_delete=models.CASCADE)
+    unread = models.IntegerField(verbose_name='Непрочитанные', default=0)
+
+    objects = NotificationCounterManager()
+
+    class Meta:
+        verbose_name = 'Счетчик уведомлений'
+        verbose_name_plural = 'Счетчики уведомлений'
+
 
 class NotificationSettings(models.Model):
     # Источник уведомления(тип)
@@ -281,10 +480,34 @@ class Patient(models.Model):
     # TODO Регионы и города
 
 
+class ServiceManager(models.Manager):
+    def sync_service_type(self, service_ids=None):
+        """
+        Пересчитывает service_type по таблицам Procedure, Event, Survey и
+        Speciality одним запросом UPDATE. Без service_ids - для всех услуг.
+        Если услуга связана с несколькими типами, берется первый по порядку.
+        """
+        queryset = self.all() if service_ids is None else self.filter(pk__in=service_ids)
+        subtypes = [('Procedure', Procedure), ('Event', Event), ('Survey', Survey), ('Speciality', Speciality)]
+        return queryset.update(service_type=models.Case(
+            *[models.When(models.Exists(model.objects.filter(service=models.OuterRef('pk'))), then=models.Value(name))
+              for name, model in subtypes],
+            default=None,
+            output_field=models.CharField(),
+        ))
+
+
 class Service(models.Model):
     sanatory = models.ForeignKey(Sanatorium, verbose_name='Санаторий', on_delete=models.CASCADE, null=True)
     name = models.CharField(max_length=255, verbose_name='Название', unique=True)
     cost = models.FloatField(verbose_name='Стоимость')
+    # Тип услуги определяется связанной записью Procedure, Event, Survey или
+    # Speciality и поддерживается сигналами, чтобы фильтр по типу был
+    # простым сравнением по индексу.
+    service_type = models.CharField(verbose_name='Тип', max_length=30, choices=SERVICE_CHOICES, null=True,
+                                    blank=True, db_index=True, editable=False)
+
+    objects = ServiceManager()
 
     class Meta:
         verbose_name = 'Услуга'
@@ -294,15 +517,64 @@ class Service(models.Model):
         return self.name
 
 
+class TimeTableManager(models.Manager):
+    def with_slot_dates(self):
+        """
+        Расписания с атрибутом slot_dates - отсортированным списком начал
+        слотов расписания из TimeSlot, собранным тем же запросом.
+        """
+        return self.annotate(slot_dates=ArrayAgg(
+            'slots__starts_at',
+            filter=models.Q(slots__isnull=False),
+            ordering='slots__starts_at',
+        ))
+
+
 class TimeTable(models.Model):
     service = models.OneToOneField(Service, verbose_name='Услуга', on_delete=models.CASCADE)
-    dates = ArrayField(models.DateTimeField(), null=True)
+    # Устарело: слоты хранятся в TimeSlot, массив остается только до
+    # переноса данных командой migrate_timetable_slots.
+    dates = ArrayField(models.DateTimeField(), null=True, blank=True)
+
+    objects = TimeTableManager()
 
     class Meta:
         verbose_name = 'Расписание'
         verbose_name_plural = 'Расписания'
 
 
+class TimeSlotManager(models.Manager):
+    def replace(self, timetable, dates):
+        """
+        Приводит слоты расписания к списку dates: удаляет лишние и добавляет
+        недостающие строки, не трогая остальные.
+        """
+        dates = set(dates)
+        self.filter(timetable=timetable).exclude(starts_at__in=dates).delete()
+        self.bulk_create([self.model(timetable=timetable, starts_at=starts_at) for starts_at in dates],
+                         ignore_conflicts=True)
+
+
+class TimeSlot(models.Model):
+    # Слоты принадлежат расписанию: удаляются вместе с ним и переходят к
+    # другой услуге, если расписание перенесли на нее
+    timetable = models.ForeignKey(TimeTable, verbose_name='Расписание', on_delete=models.CASCADE,
+                                  related_name='slots')
+    starts_at = models.DateTimeField(verbose_name='Начало')
+
+    objects = TimeSlotManager()
+
+    class Meta:
+        verbose_name = 'Слот расписания'
+        verbose_name_plural = 'Слоты расписания'
+        ordering = ['starts_at']
+        constraints = [
+            # Индекс ограничения используется и для выборки слотов расписания
+            # по диапазону времени
+            models.UniqueConstraint(fields=['timetable', 'starts_at'], name='timeslot_timetable_starts_at_uniq'),
+        ]
+
+
 class MedPersona(models.Model):
     user = models.OneToOneField(UserProfile, verbose_name='Пользователь', on_delete=models.CASCADE)
     birth_date = models.DateField(verbose_name='Дата рождения')
@@ -333,6 +605,33 @@ class ServiceMedPersona(models.Model):
         verbose_name_plural = 'Услуги-Медперсоны'  # ??
 
 
+class ScheduleRule(models.Model):
+    """
+    Правило повторяющегося расписания: по дням недели weekdays с start_time
+    до end_time слоты идут через APPOINTMENT_SLOT_DURATION. Правило действует
+    с valid_from по valid_until включительно, кроме дат из exceptions. Без
+    медперсоны правило относится ко всем медперсонам услуги.
+
+    Слоты не сохраняются в базу, а разворачиваются по запросу для нужного
+    окна (см. med.schedule).
+    """
+    service = models.ForeignKey(Service, verbose_name='Услуга', on_delete=models.CASCADE,
+                                related_name='schedule_rules')
+    medpersona = models.ForeignKey(MedPersona, verbose_name='Мед персона', on_delete=models.CASCADE, null=True,
+                                   blank=True, related_name='schedule_rules')
+    # 0 - понедельник, 6 - воскресенье
+    weekdays = ArrayField(models.PositiveSmallIntegerField(), verbose_name='Дни недели')
+    start_time = models.TimeField(verbose_name='Начало приема')
+    end_time = models.TimeField(verbose_name='Окончание приема')
+    valid_from = models.DateField(verbose_name='Действует с')
+    valid_until = models.DateField(verbose_name='Действует по', null=True, blank=True)
+    exceptions = ArrayField(models.DateField(), verbose_name='Исключения', default=list, blank=True)
+
+    class Meta:
+        verbose_name = 'Правило расписания'
+        verbose_name_plural = 'Правила расписания'
+
+
 class Medcard(models.Model):
     patient = models.OneToOneField(Patient, verbose_name='Пациент', on_delete=models.CASCADE)
     height = models.IntegerField(verbose_name='Рост', null=True, blank=True)
@@ -553,4 +852,41 @@ class MedPersonaPatient(models.Model):
 
     class Meta:
         verbose_name = 'Врач-Пациент'
-        verbose_name_plural = 'Врачи-Пациенты'
\ No newline at end of file
+        verbose_name_plural = 'Врачи-Пациенты'
+
+
+class ModelVersionManager(models.Manager):
+    def bump(self, model):
+        """ Увеличивает номер версии данных модели. """
+        label = model._meta.label_lower
+        now = timezone.now()
+        if self.filter(label=label).update(version=models.F('version') + 1, modified_at=now):
+            return
+
+        # Первое изменение модели: строки еще нет, а создать ее могут
+        # одновременно несколько процессов.
+        try:
+            with transaction.atomic():
+                self.create(label=label, version=1, modified_at=now)
+        except IntegrityError:
+            self.filter(label=label).update(version=models.F('version') + 1, modified_at=now)
+
+    def versions(self, models_list):
+        """ Возвращает {label: (версия, время изменения)} одним запросом. """
+        labels = [model._meta.label_lower for model in models_list]
+        rows = self.filter(label__in=labels).values_list('label', 'version', 'modified_at')
+        return {label: (version, modified_at) for label, version, modified_at in rows}
+
+
+class ModelVersion(models.Model):
+    # Номер версии данных справочной модели. Увеличивается сигналами при
+    # каждом сохранении или удалении записи и используется для ETag.
+    label = models.CharField(verbose_name='Модель', max_length=100, unique=True)
+    version = models.PositiveBigIntegerField(verbose_name='Версия', default=0)
+    modified_at = models.DateTimeField(verbose_name='Изменена', default=timezone.now)
+
+    objects = ModelVersionManager()
+
+    class Meta:
+        verbose_name = 'Версия данных'
+        verbose_name_plural = 'Версии данных'
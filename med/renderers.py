@@ -1,9 +1,54 @@
 import json
 
 from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class UserJSONRenderer(JSONRenderer):
+
+_encoder = encoders.JSONEncoder()
+
+
+def dumps(data):
+    """
+    Кодирует data в компактный JSON и сразу возвращает байты. Если установлен
+    orjson, используется он: даты и UUID он кодирует сам, а для Decimal,
+    ленивых строк и прочих типов DRF вызывается тот же default, что и в
+    стандартном JSONRenderer. Иначе используется стандартный json.
+    """
+    if orjson is not None:
+        ret = orjson.dumps(data, default=_encoder.default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+    else:
+        ret = json.dumps(data, cls=encoders.JSONEncoder, ensure_ascii=False, allow_nan=False,
+                         separators=(',', ':')).encode('utf-8')
+
+    # Как и JSONRenderer, экранируем U+2028 и U+2029, недопустимые в
+    # строковых литералах JavaScript
+    if b'\xe2\x80' in ret:
+        ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return ret
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer, использующий dumps. Отформатированный вывод с отступами
+    (например, для browsable API) по-прежнему строит стандартный рендерер.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        return dumps(data)
+
+
+class UserJSONRenderer(FastJSONRenderer):
     charset = 'utf-8'
 
     def render(self, data, media_type=None, renderer_context=None):
@@ -28,12 +73,12 @@ class UserJSONRenderer(JSONRenderer):
             # Как говорится выше, декодирует token если он имеет тип bytes.
             data['token'] = token.decode('utf-8')
         # Наконец, мы можем отобразить наши данные в простанстве имен 'user'.
-        return json.dumps({
+        return dumps({
             'user': data
         })
 
 
-class OtherJSONRenderer(JSONRenderer):
+class OtherJSONRenderer(FastJSONRenderer):
     charset = 'utf-8'
 
     def render(self, data, media_type=None, renderer_context=None):
@@ -62,6 +107,6 @@ class OtherJSONRenderer(JSONRenderer):
         else:
             name = data.serializer.instance.__class__.__name__.lower()
         # Наконец, мы можем отобразить наши данные в простанстве имен 'user'.
-        return json.dumps({
+        return dumps({
             name: data
         })
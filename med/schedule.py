@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils import timezone
+
+
+def get_slot_duration():
+    return getattr(settings, 'APPOINTMENT_SLOT_DURATION', timedelta(minutes=30))
+
+
+def rule_key(rule):
+    """
+    Неизменяемое описание правила. Входит в ключ кэша развертки, поэтому
+    после изменения правила старые записи кэша просто не используются.
+    """
+    return (
+        frozenset(rule.weekdays),
+        rule.start_time,
+        rule.end_time,
+        rule.valid_from,
+        rule.valid_until,
+        frozenset(rule.exceptions or ()),
+        get_slot_duration(),
+    )
+
+
+@lru_cache(maxsize=4096)
+def expand_day(key, day):
+    """ Начала слотов правила за один день. Результат кэшируется. """
+    weekdays, start_time, end_time, valid_from, valid_until, exceptions, duration = key
+    if (day.weekday() not in weekdays or day in exceptions or day < valid_from or
+            (valid_until is not None and day > valid_until)):
+        return ()
+
+    tz = timezone.get_default_timezone()
+    current = timezone.make_aware(datetime.combine(day, start_time), tz)
+    end = timezone.make_aware(datetime.combine(day, end_time), tz)
+
+    slots = []
+    while current + duration <= end:
+        slots.append(current)
+        current += duration
+    return tuple(slots)
+
+
+def occurrences(rule, window_start, window_end):
+    """
+    Генератор начал слотов правила в окне [window_start, window_end) в
+    порядке возрастания. Перебираются только дни окна, попадающие в срок
+    действия правила.
+    """
+    key = rule_key(rule)
+    tz = timezone.get_default_timezone()
+    day = max(timezone.localtime(window_start, tz).date(), rule.valid_from)
+    last = timezone.localtime(window_end, tz).date()
+    if rule.valid_until is not None:
+        last = min(last, rule.valid_until)
+
+    while day <= last:
+        for start in expand_day(key, day):
+            if window_start <= start < window_end:
+                yield start
+        day += timedelta(days=1)
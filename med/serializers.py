@@ -1,10 +1,17 @@
-from rest_framework import serializers
+import jwt
+from datetime import timedelta
+
+from rest_framework import exceptions, serializers
 from .models import *
-from django.contrib.auth import authenticate
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from drf_extra_fields.fields import Base64ImageField
+from medAppApi.sparse_fields import SparseFieldsetMixin
+from .hashing import hash_password, verify_password
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     user = serializers.StringRelatedField(read_only=True)
     password = password = serializers.CharField(
         max_length=128,
@@ -15,6 +22,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserProfile
         fields = '__all__'
+        read_only_fields = ('token_version',)
 
 
 class RegistrationSerializer(serializers.ModelSerializer):
@@ -38,6 +46,7 @@ class RegistrationSerializer(serializers.ModelSerializer):
         # Перечислить все поля, которые могут быть включены в запрос
         # или ответ, включая поля, явно указанные выше.
         fields = '__all__'
+        read_only_fields = ('token_version',)
 
     def create(self, validated_data):
         # Использовать метод create_user, который мы
@@ -50,6 +59,7 @@ class LoginSerializer(serializers.Serializer):
 
     password = serializers.CharField(max_length=128, write_only=True)
     token = serializers.CharField(max_length=255, read_only=True)
+    refresh = serializers.CharField(max_length=255, read_only=True)
     role = serializers.CharField(max_length=255, read_only=True)
 
     def validate(self, data):
@@ -72,11 +82,11 @@ class LoginSerializer(serializers.Serializer):
                 'A password is required to log in.'
             )
 
-        # Метод authenticate предоставляется Django и выполняет проверку, что
-        # предоставленные почта и пароль соответствуют какому-то пользователю в
-        # нашей базе данных. Мы передаем email как username, так как в модели
-        # пользователя USERNAME_FIELD = email.
-        user = authenticate(username=email, password=password)
+        # Проверяем, что предоставленные почта и пароль соответствуют какому-то
+        # пользователю в нашей базе данных. Это то же самое, что делает
+        # authenticate из Django, но хеширование пароля выполняется в
+        # отдельном ограниченном пуле, а не в потоке запроса.
+        user = self.authenticate(email, password)
 
         # Если пользователь с данными почтой/паролем не найден, то authenticate
         # вернет None. Возбудить исключение в таком случае.
@@ -98,11 +108,85 @@ class LoginSerializer(serializers.Serializer):
         return {
             'email': user.email,
             'token': user.token,
+            'refresh': RefreshToken.objects.issue(user),
             'role': user.role,
         }
 
+    def authenticate(self, email, password):
+        try:
+            user = UserProfile.objects.get_by_natural_key(email)
+        except UserProfile.DoesNotExist:
+            # Хешируем пароль и для несуществующего пользователя, чтобы по
+            # времени ответа нельзя было определить, существует ли почта.
+            hash_password(password)
+            return None
+
+        is_correct, must_update = verify_password(password, user.password)
+        if not is_correct:
+            return None
+
+        if must_update:
+            # Пароль тот же, меняется только алгоритм хеша, поэтому
+            # сохранение идет мимо UserProfile.save, чтобы не отзывать токены
+            user.password = hash_password(password)
+            UserProfile.objects.filter(pk=user.pk).update(password=user.password)
+
+        return user
+
+
+class TokenRefreshSerializer(serializers.Serializer):
+    """ Выдает новую пару токенов по refresh токену без проверки пароля. """
 
-class UserSerializer(serializers.ModelSerializer):
+    refresh = serializers.CharField(max_length=255)
+    token = serializers.CharField(max_length=255, read_only=True)
+    role = serializers.CharField(max_length=255, read_only=True)
+
+    def validate(self, data):
+        try:
+            payload = jwt.decode(data['refresh'], settings.SECRET_KEY, algorithms='HS256')
+        except jwt.PyJWTError:
+            raise serializers.ValidationError('Invalid or expired refresh token.')
+
+        if payload.get('type') != 'refresh':
+            raise serializers.ValidationError('Invalid or expired refresh token.')
+
+        with transaction.atomic():
+            # Блокируем запись, чтобы один и тот же refresh токен нельзя было
+            # использовать в двух параллельных запросах.
+            stored = RefreshToken.objects.select_for_update().filter(jti=payload['jti']).first()
+            if stored is None or stored.expires_at < timezone.now():
+                raise serializers.ValidationError('Invalid or expired refresh token.')
+
+            reused = stored.revoked
+            if not reused:
+                stored.revoked = True
+                stored.save(update_fields=['revoked'])
+
+        if reused:
+            # Повторное использование уже замененного токена говорит об
+            # утечке - отзываем все refresh токены пользователя.
+            RefreshToken.objects.revoke_user(stored.user_id)
+            raise serializers.ValidationError('Refresh token has already been used.')
+
+        user = stored.user
+        if payload.get('ver') != user.token_version:
+            # Токен выдан до смены пароля, роли или деактивации
+            RefreshToken.objects.revoke_user(user.pk)
+            raise exceptions.AuthenticationFailed('Refresh token has been revoked.')
+
+        if not user.is_active:
+            raise serializers.ValidationError(
+                'This user has been deactivated.'
+            )
+
+        return {
+            'token': user.token,
+            'refresh': RefreshToken.objects.issue(user),
+            'role': user.role,
+        }
+
+
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """ Ощуществляет сериализацию и десериализацию объектов User. """
 
     # Пароль должен содержать от 8 до 128 символов. Это стандартное правило. Мы
@@ -127,7 +211,7 @@ class UserSerializer(serializers.ModelSerializer):
         # состоит в том, что нам не нужно ничего указывать о поле. В поле
         # пароля требуются свойства min_length и max_length,
         # но это не относится к полю токена.
-        read_only_fields = ('token',)
+        read_only_fields = ('token', 'token_version')
 
     def update(self, instance, validated_data):
         """ Выполняет обновление User. """
@@ -150,7 +234,7 @@ class UserSerializer(serializers.ModelSerializer):
         return instance
 
 
-class MedPeronaSerializer(serializers.ModelSerializer):
+class MedPeronaSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = MedPersona
         # Перечислить все поля, которые могут быть включены в запрос
@@ -169,7 +253,7 @@ class MedPeronaSerializer(serializers.ModelSerializer):
         return instance
 
 
-class PatientSerializer(serializers.ModelSerializer):
+class PatientSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Patient
         # Перечислить все поля, которые могут быть включены в запрос
@@ -188,7 +272,7 @@ class PatientSerializer(serializers.ModelSerializer):
         return instance
 
 
-class AdminSerializer(serializers.ModelSerializer):
+class AdminSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Admin
         # Перечислить все поля, которые могут быть включены в запрос
@@ -207,7 +291,7 @@ class AdminSerializer(serializers.ModelSerializer):
         return instance
 
 
-class PassportDataSerializer(serializers.ModelSerializer):
+class PassportDataSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = PassportData
         fields = '__all__'
@@ -216,31 +300,76 @@ class PassportDataSerializer(serializers.ModelSerializer):
         return PassportData.objects.create(**validated_data)
 
 
-class SanatoriumSerializer(serializers.ModelSerializer):
+class SanatoriumSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Sanatorium
         fields = '__all__'
 
 
-class TimeTableSerializer(serializers.ModelSerializer):
+class TimeTableSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    # Для совместимости со старыми клиентами слоты по-прежнему отдаются и
+    # принимаются списком dates, но хранятся строками TimeSlot. Для чтения
+    # queryset должен быть получен через TimeTable.objects.with_slot_dates().
+    dates = serializers.ListField(child=serializers.DateTimeField(), source='slot_dates', required=False)
+
     class Meta:
         model = TimeTable
         fields = '__all__'
 
+    def create(self, validated_data):
+        dates = validated_data.pop('slot_dates', [])
+        with transaction.atomic():
+            instance = super().create(validated_data)
+            TimeSlot.objects.replace(instance, dates)
+        instance.slot_dates = sorted(set(dates))
+        return instance
+
+    def update(self, instance, validated_data):
+        dates = validated_data.pop('slot_dates', None)
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+            if dates is not None:
+                TimeSlot.objects.replace(instance, dates)
+                instance.slot_dates = sorted(set(dates))
+        return instance
+
 
-class ServiceSerializer(serializers.ModelSerializer):
+class ServiceSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Service
         fields = '__all__'
 
 
-class ServiceMedPersonaSerializer(serializers.ModelSerializer):
+class ScheduleRuleSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ScheduleRule
+        fields = '__all__'
+
+    def validate_weekdays(self, value):
+        if not value or any(day > 6 for day in value):
+            raise serializers.ValidationError('Дни недели задаются числами от 0 (понедельник) до 6.')
+        return sorted(set(value))
+
+    def validate(self, data):
+        start_time = data.get('start_time', getattr(self.instance, 'start_time', None))
+        end_time = data.get('end_time', getattr(self.instance, 'end_time', None))
+        if start_time is not None and end_time is not None and start_time >= end_time:
+            raise serializers.ValidationError('Начало приема должно быть раньше окончания.')
+
+        valid_from = data.get('valid_from', getattr(self.instance, 'valid_from', None))
+        valid_until = data.get('valid_until', getattr(self.instance, 'valid_until', None))
+        if valid_from is not None and valid_until is not None and valid_from > valid_until:
+            raise serializers.ValidationError('Дата начала действия должна быть не позже даты окончания.')
+        return data
+
+
+class ServiceMedPersonaSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = ServiceMedPersona
         fields = '__all__'
 
 
-class EventSerializer(serializers.ModelSerializer):
+class EventSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     photo = Base64ImageField(required=False, use_url=True)
 
     class Meta:
@@ -248,7 +377,7 @@ class EventSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class SurveySerializer(serializers.ModelSerializer):
+class SurveySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     photo = Base64ImageField(required=False)
 
     class Meta:
@@ -256,13 +385,13 @@ class SurveySerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class SpecialitySerializer(serializers.ModelSerializer):
+class SpecialitySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Speciality
         fields = '__all__'
 
 
-class ProcedureSerializer(serializers.ModelSerializer):
+class ProcedureSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     photo = Base64ImageField(required=False)
 
     class Meta:
@@ -270,13 +399,42 @@ class ProcedureSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class MedcardSerializer(serializers.ModelSerializer):
+class MedcardSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Medcard
         fields = '__all__'
 
 
-class MedPersonaPatientSerializer(serializers.ModelSerializer):
+class MedPersonaPatientSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = MedPersonaPatient
         fields = '__all__'
+
+
+class PeriodQuerySerializer(serializers.Serializer):
+    """ Параметры запроса за период: ?from=&to= """
+    to = serializers.DateTimeField()
+    max_window_setting = None
+    default_max_window = timedelta(days=31)
+
+    def get_fields(self):
+        # from - ключевое слово, поэтому поле нельзя объявить атрибутом класса
+        fields = super().get_fields()
+        fields['from'] = serializers.DateTimeField()
+        return fields
+
+    def validate(self, data):
+        window = data['to'] - data['from']
+        if window <= timedelta(0):
+            raise serializers.ValidationError('Начало периода должно быть раньше окончания.')
+
+        max_window = getattr(settings, self.max_window_setting, self.default_max_window)
+        if window > max_window:
+            raise serializers.ValidationError('Период не может быть длиннее %d дней.' % max_window.days)
+        return data
+
+
+class AvailabilityQuerySerializer(PeriodQuerySerializer):
+    """ Параметры запроса свободных слотов: ?from=&to=&service= """
+    service = serializers.IntegerField(required=False)
+    max_window_setting = 'AVAILABILITY_MAX_WINDOW'
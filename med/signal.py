@@ -1,5 +1,76 @@
-from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
-from .models import UserProfile
+from medAppApi.events import publish
+from .cache import user_cache, token_state_cache
+from .versioning import bump_version
+from .models import (UserProfile, Sanatorium, Service, Procedure, Survey, Event, Speciality,
+                     TimeTable, Notification)
+
+# Справочники, по версиям которых строятся ETag и Last-Modified
+VERSIONED_MODELS = (Sanatorium, Service, Procedure, Survey, Event, Speciality, TimeTable)
+# Таблицы, определяющие Service.service_type
+SERVICE_SUBTYPE_MODELS = (Procedure, Event, Survey, Speciality)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_user_cache(sender, instance, **kwargs):
+    # Снимок пользователя в кэше аутентификации устаревает при любом изменении
+    # или удалении записи. Кэш процессный, поэтому в других процессах запись
+    # доживет не дольше JWT_USER_CACHE_TTL.
+    user_cache.delete(instance.pk)
+    token_state_cache.delete(instance.pk)
+
+
+def bump_model_version(sender, **kwargs):
+    bump_version(sender)
+
+
+for model in VERSIONED_MODELS:
+    label = model._meta.label_lower
+    post_save.connect(bump_model_version, sender=model, dispatch_uid='bump_version_save_%s' % label)
+    post_delete.connect(bump_model_version, sender=model, dispatch_uid='bump_version_delete_%s' % label)
+
+
+def remember_service(sender, instance, **kwargs):
+    # Запоминаем прежнюю услугу, чтобы при переносе записи на другую услугу
+    # пересчитать тип у обеих.
+    instance._previous_service_id = None
+    if instance.pk is not None:
+        instance._previous_service_id = sender.objects.filter(pk=instance.pk).values_list(
+            'service_id', flat=True).first()
+
+
+def sync_service_type(sender, instance, **kwargs):
+    service_ids = {instance.service_id, getattr(instance, '_previous_service_id', None)} - {None}
+    if service_ids and Service.objects.sync_service_type(service_ids):
+        # update() не вызывает сигналы Service, версию увеличиваем сами
+        bump_version(Service)
+
+
+for model in SERVICE_SUBTYPE_MODELS:
+    label = model._meta.label_lower
+    pre_save.connect(remember_service, sender=model, dispatch_uid='remember_service_%s' % label)
+    post_save.connect(sync_service_type, sender=model, dispatch_uid='sync_service_type_save_%s' % label)
+    post_delete.connect(sync_service_type, sender=model, dispatch_uid='sync_service_type_delete_%s' % label)
+
+
+def publish_notifications(notifications):
+    """
+    Отправляет подключенным пользователям события о новых уведомлениях.
+    Текст уведомления в событие не входит, клиент загружает его по id.
+    """
+    for notification in notifications:
+        publish([notification.user_id], {
+            'type': 'notification',
+            'id': notification.pk,
+            'source': notification.source,
+            'status': notification.status,
+        })
+
+
+@receiver(post_save, sender=Notification)
+def push_notification(sender, instance, created, **kwargs):
+    if created:
+        publish_notifications([instance])
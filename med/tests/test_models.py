@@ -1,4 +1,7 @@
+from io import StringIO
+
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from rest_framework.test import APITestCase
 from med.models import *
 
@@ -119,6 +122,26 @@ class UserProfileTests(APITestCase):
         self.assertEquals(user2.get_name(), 'name2 surname2')
         self.assertEquals(user3.get_name(), 'name3 patronymic3')
 
+    # Тест отзыва токенов при сохранении части полей
+    def test_token_version_update_fields(self):
+        version = self.user.token_version
+
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        self.assertEquals(UserProfile.objects.get(pk=self.user.pk).token_version, version + 1)
+
+        self.user.role = 'Doctor'
+        self.user.save(update_fields=['role'])
+        self.user.set_password('newpassword')
+        self.user.save(update_fields=['password'])
+        self.assertEquals(UserProfile.objects.get(pk=self.user.pk).token_version, version + 3)
+
+        # Поля, не попадающие в токен, и повторное сохранение версию не меняют
+        self.user.name = 'renamed'
+        self.user.save(update_fields=['name', 'role'])
+        self.user.save()
+        self.assertEquals(UserProfile.objects.get(pk=self.user.pk).token_version, version + 3)
+
 
 class AdminTests(APITestCase):
     @classmethod
@@ -274,7 +297,37 @@ class MedPersonaTests(APITestCase):
 
 '''Для остальных тесты можно написать потом '''
 
-# Услуга
+
+class ServiceTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = Service.objects.create(name='service1', cost=100)
+        cls.other = Service.objects.create(name='service2', cost=200)
+
+    def test_service_type(self):
+        self.assertIsNone(Service.objects.get(pk=self.service.pk).service_type)
+
+        procedure = Procedure.objects.create(service=self.service, description='description', placement='101')
+        self.assertEqual(Service.objects.get(pk=self.service.pk).service_type, 'Procedure')
+
+        # Перенос процедуры на другую услугу
+        procedure.service = self.other
+        procedure.save()
+        self.assertIsNone(Service.objects.get(pk=self.service.pk).service_type)
+        self.assertEqual(Service.objects.get(pk=self.other.pk).service_type, 'Procedure')
+
+        procedure.delete()
+        self.assertIsNone(Service.objects.get(pk=self.other.pk).service_type)
+
+    def test_backfill(self):
+        Speciality.objects.create(service=self.service)
+        Service.objects.update(service_type=None)
+
+        call_command('backfill_service_type', stdout=StringIO())
+        self.assertEqual(Service.objects.get(pk=self.service.pk).service_type, 'Speciality')
+        self.assertEqual(list(Service.objects.filter(service_type='Speciality')), [self.service])
+
+
 # Услуга-Медперсона
 # Процедура
 # Обследование
@@ -284,7 +337,84 @@ class MedPersonaTests(APITestCase):
 # Санаторий
 # Новости
 # Трансляция
-# Расписание
+
+
+class TimeSlotTests(APITestCase):
+    def test_migrate_timetable_slots(self):
+        service = Service.objects.create(name='service1', cost=100)
+        dates = [timezone.now().replace(microsecond=0) + timedelta(hours=hour) for hour in range(3)]
+        timetable = TimeTable.objects.create(service=service, dates=dates + dates[:1])
+
+        call_command('migrate_timetable_slots', '--clear', stdout=StringIO())
+        call_command('migrate_timetable_slots', stdout=StringIO())
+        self.assertEqual(list(TimeSlot.objects.filter(timetable=timetable).values_list('starts_at', flat=True)), dates)
+        self.assertEqual(TimeTable.objects.with_slot_dates().get(service=service).slot_dates, dates)
+        self.assertIsNone(TimeTable.objects.get(service=service).dates)
+
+
+class NotificationCounterTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Patient',
+            password='user1password',
+        )
+
+    def create(self, status='Not Sended'):
+        return Notification.objects.create(user=self.user, name='name', description='description',
+                                           source='source', status=status)
+
+    def unread(self):
+        return NotificationCounter.objects.get(user=self.user).unread
+
+    def test_counter(self):
+        first = self.create()
+        self.create()
+        self.create(status='Sended')
+        self.assertEqual(self.unread(), 2)
+
+        first.status = 'Sended'
+        first.save()
+        self.assertEqual(self.unread(), 1)
+        first.save()
+        self.assertEqual(self.unread(), 1)
+
+        Notification.objects.filter(status='Not Sended').get().delete()
+        self.assertEqual(self.unread(), 0)
+
+    def test_insert_new(self):
+        existing = Notification.objects.create(user=self.user, name='name', description='description',
+                                               source='source', status='Not Sended', dedup_key='first')
+        created = Notification.objects.insert_new([
+            Notification(user=self.user, name='name', description='description', source='source',
+                         status='Not Sended', dedup_key=key)
+            for key in ('first', 'second')
+        ])
+        self.assertEqual([notification.dedup_key for notification in created], ['second'])
+        self.assertEqual(Notification.objects.get(dedup_key='second').pk, created[0].pk)
+        self.assertNotEqual(created[0].pk, existing.pk)
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_rebuild(self):
+        self.create()
+        # Массовые изменения в обход модели счетчик не обновляют
+        Notification.objects.update(status='Sended')
+        Notification.objects.bulk_create([
+            Notification(user=self.user, name='name', description='description', source='source',
+                         status='Not Sended')
+            for _ in range(3)
+        ])
+        self.assertEqual(self.unread(), 1)
+
+        call_command('rebuild_notification_counters', stdout=StringIO())
+        self.assertEqual(self.unread(), 3)
+
+
 
 # Рекомендация
 # Рекомендация-Процедура
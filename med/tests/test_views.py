@@ -1,13 +1,62 @@
-from rest_framework.test import APITestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.test import TransactionTestCase
+from rest_framework.request import Request
+from rest_framework.test import APITestCase, APIRequestFactory
 from rest_framework import status
 from django.urls import reverse
 from django.http import HttpRequest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from med.views import *
+from med.cache import user_cache, token_state_cache
+from med.hashing import hashing_pool, HashingPool, HashingPoolBusy
+from med.throttling import bucket_store, AuthEmailThrottle
+from med.versioning import get_catalog_cache, cache_metrics
+from med.availability import IntervalSet, get_medic_bookings
+from medAppApi.asgi import application
+from medAppApi.pagination import KeysetCursorPagination
+from medAppApi.events import EVENTS_PATH, hub, publish
+from organizer.models import Record, RecordService, RecordServiceMedPersona
+import datetime
+import decimal
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+from django.utils.http import http_date
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
 
 
-class RegistrationAPIViewTests(APITestCase):
+class IsolatedThrottleStoreMixin:
+    """
+    Throttling пишет во временный файл, а не в общий THROTTLE_STORE_PATH,
+    который может использовать запущенный сервер.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        cls.addClassCleanup(bucket_store.configure, bucket_store.path, bucket_store.slots)
+        bucket_store.configure(os.path.join(directory.name, 'throttle.bin'), bucket_store.slots)
+        super().setUpClass()
+
+
+class RegistrationAPIViewTests(IsolatedThrottleStoreMixin, APITestCase):
     def setUp(self):
         self.url = reverse('registration')
+        bucket_store.clear()
+
+    def test_isolated_throttle_store(self):
+        self.assertNotEqual(bucket_store.path, os.path.join(tempfile.gettempdir(), 'medapp-throttle.bin'))
+        self.assertTrue(os.path.exists(os.path.dirname(bucket_store.path)))
 
     def test_post(self):
         data = {
@@ -59,8 +108,33 @@ class RegistrationAPIViewTests(APITestCase):
             response = self.client.post(self.url, incorrect_data, format='json')
             self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_hashing_pool_busy(self):
+        data = {
+            'user': {
+                'email': 'user1@mail.com',
+                'phone_number': '+79998887766',
+                'role': 'Patient',
+                'name': 'name1',
+                'surname': 'surname1',
+                'patronymic': 'patronymic1',
+                'password': 'user1password',
+                'photo': None,
+            }
+        }
+        # Пул хеширования заполнен: регистрация сразу получает 503
+        release = threading.Event()
+        futures = [hashing_pool.submit(release.wait) for _ in range(hashing_pool.max_pending)]
+        try:
+            response = self.client.post(self.url, data, format='json')
+            self.assertEquals(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertFalse(UserProfile.objects.filter(email='user1@mail.com').exists())
+        finally:
+            release.set()
+            for future in futures:
+                future.result()
+
 
-class LoginAPIViewTests(APITestCase):
+class LoginAPIViewTests(IsolatedThrottleStoreMixin, APITestCase):
     @classmethod
     def setUpTestData(cls):
         UserProfile.objects.create_user(
@@ -93,6 +167,7 @@ class LoginAPIViewTests(APITestCase):
 
     def setUp(self):
         self.url = reverse('login')
+        bucket_store.clear()
 
     def test_response_fields(self):
         data = {
@@ -155,6 +230,155 @@ class LoginAPIViewTests(APITestCase):
             response = self.client.post(self.url, incorrect_data, format='json')
             self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_hashing_pool_busy(self):
+        data = {
+            'user': {
+                'email': 'user1@mail.com',
+                'password': 'user1password',
+            }
+        }
+        # Занимаем всю очередь пула хеширования
+        release = threading.Event()
+        futures = [hashing_pool.submit(release.wait) for _ in range(hashing_pool.max_pending)]
+        try:
+            response = self.client.post(self.url, data, format='json')
+            self.assertEquals(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            release.set()
+            for future in futures:
+                future.result()
+
+        response = self.client.post(self.url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_hashing_pool_limits(self):
+        # Пул заполняется раньше, чем заканчиваются потоки сервера: 503
+        # отдается, когда заняты потоки хеширования и очередь, а свободные
+        # потоки waitress еще остаются
+        self.assertGreater(hashing_pool.max_pending, hashing_pool.workers)
+        self.assertLess(hashing_pool.max_pending, settings.SERVER_THREADS)
+
+        pool = HashingPool(workers=1, max_pending=2, timeout=5, server_threads=4)
+        started = threading.Event()
+        release = threading.Event()
+
+        def job():
+            started.set()
+            release.wait()
+
+        futures = [pool.submit(job) for _ in range(2)]
+        try:
+            self.assertTrue(started.wait(5))
+            metrics = pool.metrics()
+            self.assertEquals(metrics['running'], 1)
+            self.assertEquals(metrics['queue_depth'], 1)
+            with self.assertRaises(HashingPoolBusy):
+                pool.run(make_password, 'password')
+        finally:
+            release.set()
+            for future in futures:
+                future.result()
+        self.assertTrue(pool.run(make_password, 'password'))
+        self.assertEquals(pool.metrics()['rejected'], 1)
+        self.assertEquals(pool.metrics()['queue_depth'], 0)
+
+        with self.assertRaises(ImproperlyConfigured):
+            HashingPool(workers=2, max_pending=4, timeout=5, server_threads=4)
+
+    def test_throttling(self):
+        data = {
+            'user': {
+                'email': 'user2@mail.com',
+                'password': 'wrongpassword',
+            }
+        }
+        rejected = AuthEmailThrottle.metrics()['rejected']
+        capacity = AuthEmailThrottle().capacity
+        for _ in range(capacity):
+            response = self.client.post(self.url, data, format='json')
+            self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Корзина для почты пуста, остальные пользователи не затронуты
+        response = self.client.post(self.url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertTrue('Retry-After' in response)
+        self.assertEquals(AuthEmailThrottle.metrics()['rejected'], rejected + 1)
+
+        data['user']['email'] = 'user1@mail.com'
+        data['user']['password'] = 'user1password'
+        response = self.client.post(self.url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+
+class TokenRefreshAPIViewTests(IsolatedThrottleStoreMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Patient',
+            password='user1password',
+        )
+
+    def setUp(self):
+        self.url = reverse('token-refresh')
+        bucket_store.clear()
+        data = {
+            'user': {
+                'email': 'user1@mail.com',
+                'password': 'user1password',
+            }
+        }
+        response = self.client.post(reverse('login'), data, format='json')
+        self.refresh = response.data['refresh']
+
+    def test_post(self):
+        response = self.client.post(self.url, {'user': {'refresh': self.refresh}}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        for field in ['token', 'refresh', 'role']:
+            self.assertTrue(field in response.data)
+        new_refresh = response.data['refresh']
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['token'])
+        response = self.client.get(reverse('user'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        # Повторное использование старого токена отзывает и новый
+        self.client.credentials()
+        response = self.client.post(self.url, {'user': {'refresh': self.refresh}}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.url, {'user': {'refresh': new_refresh}}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_password_change(self):
+        user = UserProfile.objects.get(email='user1@mail.com')
+        user.set_password('user1newpassword')
+        user.save()
+
+        response = self.client.post(self.url, {'user': {'refresh': self.refresh}}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated(self):
+        user = UserProfile.objects.get(email='user1@mail.com')
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+
+        response = self.client.post(self.url, {'user': {'refresh': self.refresh}}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(RefreshToken.objects.filter(revoked=False).exists())
+
+    def test_refresh_is_not_access_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.refresh)
+        response = self.client.get(reverse('user'))
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.credentials()
+        response = self.client.post(self.url, {'user': {'refresh': 'not a token'}}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 
 class UserRetrieveUpdateAPIViewTests(APITestCase):
     @classmethod
@@ -382,9 +606,670 @@ class MedPersonaAPIViewTests(APITestCase):
         check_post_status(ok_list, min_data, status.HTTP_400_BAD_REQUEST)
         check_post_status(not_found_list, min_data, status.HTTP_201_CREATED)
 
+
+class JWTAuthenticationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Patient',
+            password='user1password',
+        )
+
+    def setUp(self):
+        self.url = reverse('user')
+        self.user = UserProfile.objects.get(email='user1@mail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.user.token)
+        user_cache.clear()
+        token_state_cache.clear()
+
+    def test_cached_user(self):
+        with CaptureQueriesContext(connection) as first:
+            response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        # Повторный запрос не должен обращаться к базе за пользователем
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        user_queries = [q for q in second if 'FROM "med_userprofile"' in q['sql']]
+        self.assertEquals(user_queries, [])
+
+    def test_role_permission_without_user_query(self):
+        # Роль берется из токена, поэтому отказ в доступе к списку
+        # пользователей обходится без загрузки пользователя
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/med/users')
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_role_change_revokes_token(self):
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.user.role = 'Doctor'
+        self.user.save()
+
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        user = UserProfile.objects.get(email='user1@mail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + user.token)
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['role'], 'Doctor')
+
+    def test_invalidation(self):
+        self.client.get(self.url)
+
+        self.user.name = 'new name1'
+        self.user.save()
+
+        response = self.client.get(self.url)
+        self.assertEquals(response.data['name'], 'new name1')
+
+        self.user.is_active = False
+        self.user.save()
+
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class KeysetCursorPaginationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            Service.objects.create(name='service%d' % i, cost=100 + i)
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.url = '/api/med/service'
+
+    def test_without_pagination(self):
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(len(response.data), 5)
+
+    def test_pages(self):
+        names = []
+        url = self.url + '?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(len(response.data['results']) <= 2)
+            names += [service['name'] for service in response.data['results']]
+            url = response.data['next']
+
+        self.assertEquals(names, ['service%d' % i for i in range(5)])
+
+    def test_max_page_size(self):
+        response = self.client.get(self.url + '?page_size=100000')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(len(response.data['results']), 5)
+        self.assertIsNone(response.data['next'])
+
+    def paginate(self, ordering, page_size=2, queryset=None):
+        # Все страницы с сортировкой ordering и SQL запросов страниц
+        view = type('View', (), {'ordering': ordering})()
+        paginator = KeysetCursorPagination()
+        params = {'page_size': page_size}
+        names, queries = [], []
+        while True:
+            request = Request(APIRequestFactory().get('/', params))
+            with CaptureQueriesContext(connection) as captured:
+                page = paginator.paginate_queryset(queryset or Service.objects.all(), request, view)
+            names += [service.name for service in page]
+            queries += [query['sql'] for query in captured]
+            if not paginator.has_next:
+                return names, queries
+            params['cursor'] = paginator.encode_cursor(
+                [paginator._get_value(page[-1], field.lstrip('-')) for field in paginator.ordering])
+
+    def test_row_comparison(self):
+        names, queries = self.paginate(['-name'])
+        self.assertEquals(names, ['service%d' % i for i in reversed(range(5))])
+        self.assertIn('("med_service"."name", "med_service"."id") < (', queries[-1])
+
+        # Смешанные направления: группы полей одного направления
+        Service.objects.filter(name__in=['service1', 'service3']).update(cost=100)
+        names, queries = self.paginate(['cost', '-name'])
+        self.assertEquals(names, ['service3', 'service1', 'service0', 'service2', 'service4'])
+        self.assertIn('("med_service"."cost") > (', queries[-1])
+
+    def test_deep_page_index(self):
+        Service.objects.bulk_create([Service(name='bulk%d' % i, cost=100) for i in range(500)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE med_service')
+
+        last = Service.objects.order_by('-id')[20]
+        request = Request(APIRequestFactory().get('/', {
+            'page_size': 10,
+            'cursor': KeysetCursorPagination().encode_cursor([last.id]),
+        }))
+        paginator = KeysetCursorPagination()
+        with CaptureQueriesContext(connection) as captured:
+            page = paginator.paginate_queryset(Service.objects.all(), request, None)
+        self.assertEquals(page[0].id, last.id + 1)
+
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + captured[-1]['sql'])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        # Позиция курсора - начало диапазона в индексе, а не фильтр
+        self.assertIn('Index Cond', plan, plan)
+        self.assertIn('med_service_pkey', plan, plan)
+        self.assertNotIn('Filter', plan, plan)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url + '?cursor=garbage')
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get(self.url + '?cursor=WyJhIl0=')
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ServiceTypeFilterTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            Service.objects.create(name='service%d' % i, cost=100 + i)
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.url = '/api/med/service'
+
+    def test_service_type_filter(self):
+        service = Service.objects.get(name='service3')
+        Event.objects.create(service=service, description='description', begin_data=datetime.date(2021, 5, 1),
+                             placement='101')
+
+        response = self.client.get(self.url + '?service_type=Event')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([item['name'] for item in response.data], ['service3'])
+        self.assertEquals(response.data[0]['service_type'], 'Event')
+
+
+class StreamingListTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(7):
+            service = Service.objects.create(name='service%d' % i, cost=100 + i)
+            Procedure.objects.create(service=service, description='description%d' % i, placement='101')
+
+    def setUp(self):
+        get_catalog_cache().clear()
+
+    def test_stream(self):
+        response = self.client.get('/api/med/procedure')
+        expected = response.json()
+
+        response = self.client.get('/api/med/procedure?stream=1')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        self.assertEquals(json.loads(content), expected)
+
+    def test_stream_empty(self):
+        Procedure.objects.all().delete()
+        response = self.client.get('/api/med/procedure?stream=1')
+        self.assertEquals(json.loads(b''.join(response.streaming_content)), [])
+
+
+class SparseFieldsetTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        service = Service.objects.create(name='service', cost=100)
+        Procedure.objects.create(service=service, description='description', placement='101')
+
+    def setUp(self):
+        get_catalog_cache().clear()
+
+    def test_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/med/procedure?fields=id,placement')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(set(response.data[0].keys()), {'id', 'placement'})
+        self.assertNotIn('"description"', ' '.join(query['sql'] for query in queries))
+
+    def test_exclude(self):
+        response = self.client.get('/api/med/procedure?exclude=description,photo')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('description', response.data[0])
+        self.assertEquals(response.data[0]['placement'], '101')
+
+
+class ConditionalGetTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = Service.objects.create(name='service', cost=100)
+        Procedure.objects.create(service=cls.service, description='description', placement='101')
+
+    def setUp(self):
+        get_catalog_cache().clear()
+
+    def test_not_modified(self):
+        # Секунда последнего изменения уже прошла
+        with mock.patch('med.versioning.time.time', return_value=time.time() + 2):
+            response = self.client.get('/api/med/procedure')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # Версии уже в кэше, поэтому база не нужна вовсе
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/med/procedure', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response['ETag'], etag)
+
+    def test_modified(self):
+        etag = self.client.get('/api/med/service')['ETag']
+
+        Procedure.objects.create(service=Service.objects.create(name='other', cost=10),
+                                 description='description', placement='102')
+
+        response = self.client.get('/api/med/service', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertNotEquals(response['ETag'], etag)
+        self.assertEquals(len(response.data), 2)
+
+    def test_same_second(self):
+        second = datetime.datetime(2021, 5, 3, 10, tzinfo=datetime.timezone.utc)
+        ModelVersion.objects.filter(label='med.procedure').update(
+            modified_at=second + datetime.timedelta(milliseconds=200))
+
+        # Ответ в ту же секунду, что и изменение, идет без Last-Modified
+        with mock.patch('med.versioning.time.time', return_value=second.timestamp() + 0.4):
+            response = self.client.get('/api/med/procedure')
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        # Второе изменение в ту же секунду: If-Modified-Since со временем
+        # этой секунды не дает 304
+        Procedure.objects.create(service=Service.objects.create(name='other', cost=10),
+                                 description='description', placement='102')
+        ModelVersion.objects.filter(label='med.procedure').update(
+            modified_at=second + datetime.timedelta(milliseconds=700))
+        get_catalog_cache().clear()
+        with mock.patch('med.versioning.time.time', return_value=second.timestamp() + 0.9):
+            response = self.client.get('/api/med/procedure', HTTP_IF_MODIFIED_SINCE=http_date(second.timestamp()))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(len(response.data), 2)
+
+        # После окончания секунды Last-Modified снова отдается
+        with mock.patch('med.versioning.time.time', return_value=second.timestamp() + 1):
+            response = self.client.get('/api/med/procedure', HTTP_IF_MODIFIED_SINCE=http_date(second.timestamp()))
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response['Last-Modified'], http_date(second.timestamp()))
+
+    def test_response_cache(self):
+        hits = cache_metrics()['hit']
+        expected = self.client.get('/api/med/service').json()
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/med/service')
+        self.assertEquals(response.json(), expected)
+        self.assertEquals(cache_metrics()['hit'], hits + 1)
+
+        self.service.name = 'renamed'
+        self.service.save()
+
+        response = self.client.get('/api/med/service')
+        self.assertEquals(response.data[0]['name'], 'renamed')
+
+
+class TimetableFilterTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = Service.objects.create(name='service', cost=100)
+        TimeTable.objects.create(service=cls.service)
+        cls.other = Service.objects.create(name='other', cost=100)
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.url = '/api/med/timetable'
+
+    def test_single_query(self):
+        # Первый запрос загружает версии справочников в кэш
+        self.client.get(self.url)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url + '?service=%d' % self.service.pk)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([item['service'] for item in response.data], [self.service.pk])
+
+    def test_dates(self):
+        dates = ['2021-05-03T10:00:00Z', '2021-05-03T09:00:00Z']
+        response = self.client.post(self.url, {'service': self.other.pk, 'dates': dates}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(response.json()['dates'], sorted(dates))
+        self.assertEquals(TimeSlot.objects.filter(timetable__service=self.other).count(), 2)
+
+        url = '%s/%d' % (self.url, response.data['id'])
+        response = self.client.patch(url, {'dates': ['2021-05-03T09:00:00Z', '2021-05-03T11:00:00Z']}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(url)
+        self.assertEquals(response.json()['dates'], ['2021-05-03T09:00:00Z', '2021-05-03T11:00:00Z'])
+
+    def test_move_and_delete(self):
+        dates = ['2021-05-03T09:00:00Z', '2021-05-03T10:00:00Z']
+        response = self.client.post(self.url, {'service': self.other.pk, 'dates': dates}, format='json')
+        url = '%s/%d' % (self.url, response.data['id'])
+
+        # Слоты переходят вместе с расписанием к другой услуге
+        third = Service.objects.create(name='third', cost=100)
+        response = self.client.patch(url, {'service': third.pk}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(TimeSlot.objects.filter(timetable__service=self.other).exists())
+        self.assertEquals(TimeSlot.objects.filter(timetable__service=third).count(), 2)
+        self.assertEquals(self.client.get(url).json()['dates'], dates)
+
+        # и удаляются вместе с ним
+        response = self.client.delete(url)
+        self.assertEquals(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(TimeSlot.objects.filter(timetable__service=third).exists())
+
+    def test_missing_service(self):
+        response = self.client.get(self.url + '?service=%d' % (self.service.pk + 1000))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data, [])
+
+
+class MedPersonaAvailabilityTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Doctor',
+            password='user1password',
+        )
+        cls.medpersona = MedPersona.objects.create(
+            user=user,
+            birth_date='2001-08-03',
+            position='Specialist',
+            qualification='3',
+            experience='5 years',
+        )
+        patient_user = UserProfile.objects.create_user(
+            email='user2@mail.com',
+            name='name2',
+            surname='surname2',
+            patronymic='patronymic2',
+            phone_number='+79998887755',
+            role='Patient',
+            password='user2password',
+        )
+        patient = Patient.objects.create(user=patient_user, gender='Male', region='region', city='city',
+                                         type='Treating', group=[])
+
+        cls.day = datetime.datetime(2021, 5, 3, tzinfo=datetime.timezone.utc)
+        cls.service = Service.objects.create(name='service', cost=100)
+        ServiceMedPersona.objects.create(service=cls.service, medpersona=cls.medpersona, type='Procedure')
+        cls.timetable = TimeTable.objects.create(service=cls.service)
+        TimeSlot.objects.replace(cls.timetable, [cls.day + datetime.timedelta(hours=hour) for hour in (11, 9, 10)])
+
+        # Запись на 10:15 - 10:45 занимает слот 10:00
+        record = Record.objects.create(name='record', patient=patient,
+                                       date_start=cls.day + datetime.timedelta(hours=10, minutes=15),
+                                       date_end=cls.day + datetime.timedelta(hours=10, minutes=45))
+        record_service = RecordService.objects.create(record=record, service=cls.service)
+        RecordServiceMedPersona.objects.create(record_service=record_service, medpersona=cls.medpersona)
+
+    def setUp(self):
+        self.url = reverse('availability', kwargs={'pk': self.medpersona.pk})
+        self.client.force_authenticate(user=self.medpersona.user)
+
+    def test_free_slots(self):
+        response = self.client.get(self.url, {
+            'from': self.day.isoformat(),
+            'to': (self.day + datetime.timedelta(days=1)).isoformat(),
+        })
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([slot['start'] for slot in response.data],
+                          [self.day + datetime.timedelta(hours=9), self.day + datetime.timedelta(hours=11)])
+        self.assertEquals(response.data[0]['service'], self.service.pk)
+
+        # Слот 11:00 - 11:30 не помещается в окно
+        response = self.client.get(self.url, {
+            'from': self.day.isoformat(),
+            'to': (self.day + datetime.timedelta(hours=11, minutes=15)).isoformat(),
+            'service': self.service.pk,
+        })
+        self.assertEquals(len(response.data), 1)
+
+    def test_bookings_index(self):
+        # Занятость выбирается по GiST индексу ограничения, а не по всем
+        # записям медперсоны
+        with CaptureQueriesContext(connection) as captured:
+            busy = get_medic_bookings(self.medpersona.pk, self.day, self.day + datetime.timedelta(days=1))
+        self.assertEquals(len(busy), 1)
+
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + captured[-1]['sql'])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('record_medpersona_no_overlap', plan, plan)
+        self.assertNotIn('organizer_record ', plan, plan)
+
+        busy = get_medic_bookings(self.medpersona.pk, self.day + datetime.timedelta(hours=11),
+                                  self.day + datetime.timedelta(hours=12))
+        self.assertEquals(len(busy), 0)
+
+    def test_deleted_timetable(self):
+        self.timetable.delete()
+        response = self.client.get(self.url, {
+            'from': self.day.isoformat(),
+            'to': (self.day + datetime.timedelta(days=1)).isoformat(),
+        })
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data, [])
+
+    def test_schedule_rules(self):
+        # 2021-05-03 - понедельник, 2021-05-10 - исключение
+        ScheduleRule.objects.create(service=self.service, weekdays=[0], start_time=datetime.time(14),
+                                    end_time=datetime.time(15), valid_from=datetime.date(2021, 5, 1),
+                                    exceptions=[datetime.date(2021, 5, 10)])
+        ScheduleRule.objects.create(service=self.service, medpersona=None, weekdays=[1],
+                                    start_time=datetime.time(9), end_time=datetime.time(10),
+                                    valid_from=datetime.date(2021, 5, 1), valid_until=datetime.date(2021, 5, 2))
+
+        response = self.client.get(self.url, {
+            'from': self.day.isoformat(),
+            'to': (self.day + datetime.timedelta(days=14)).isoformat(),
+        })
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        rule_slots = [slot['start'] for slot in response.data if slot['start'].hour >= 14]
+        self.assertEquals(rule_slots, [
+            self.day + datetime.timedelta(hours=14),
+            self.day + datetime.timedelta(hours=14, minutes=30),
+        ])
+
+    def test_schedule_rule_api(self):
+        admin = UserProfile.objects.create_user(email='admin@mail.com', name='admin', surname='admin',
+                                                patronymic='admin', phone_number='+79998887700', role='Admin',
+                                                password='adminpassword')
+        self.client.force_authenticate(user=admin)
+        data = {
+            'service': self.service.pk,
+            'weekdays': [4, 0, 0],
+            'start_time': '10:00',
+            'end_time': '09:00',
+            'valid_from': '2021-05-01',
+        }
+        response = self.client.post(reverse('schedule-rules'), data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        data['end_time'] = '12:00'
+        response = self.client.post(reverse('schedule-rules'), data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(response.data['weekdays'], [0, 4])
+
+    def test_invalid_window(self):
+        response = self.client.get(self.url, {'from': self.day.isoformat(), 'to': self.day.isoformat()})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(self.url, {
+            'from': self.day.isoformat(),
+            'to': (self.day + datetime.timedelta(days=365)).isoformat(),
+        })
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_interval_set(self):
+        busy = IntervalSet([(5, 7), (1, 3), (2, 4)])
+        self.assertEquals((busy.starts, busy.ends), ([1, 5], [4, 7]))
+        self.assertTrue(busy.overlaps(3, 6))
+        self.assertFalse(busy.overlaps(4, 5))
+        self.assertFalse(busy.overlaps(7, 9))
+
+
+class FastJSONRendererTests(APITestCase):
+    def test_matches_json_renderer(self):
+        data = {
+            'date': datetime.datetime(2021, 5, 1, 10, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2021, 5, 1),
+            'cost': decimal.Decimal('10.50'),
+            'lazy': gettext_lazy('Запись'),
+            'text': 'строка\u2028',
+            'list': [1, None, True],
+        }
+        self.assertEquals(json.loads(FastJSONRenderer().render(data)),
+                          json.loads(JSONRenderer().render(data)))
+
 # PatientAPIView
 # AdminAPIView
 
 # PassportDataAPIView
 # SanatoriumView
 # SingleSanatoriumView
+
+
+class NotificationSummaryTests(APITestCase):
+    def setUp(self):
+        self.url = reverse('notifications-summary')
+        self.user = UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Patient',
+            password='user1password',
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.data, {'unread': 0})
+
+        for status_ in ('Not Sended', 'Not Sended', 'Sended'):
+            Notification.objects.create(user=self.user, name='name', description='description', source='source',
+                                        status=status_)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'unread': 2})
+
+    def test_unauthenticated(self):
+        self.client.force_authenticate(user=None)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class EventsWebSocketTests(TransactionTestCase):
+    # События доставляются через NOTIFY только после фиксации транзакции,
+    # поэтому тесты работают без оборачивающей транзакции
+    def setUp(self):
+        self.user = UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Patient',
+            password='user1password',
+        )
+        self.patient = Patient.objects.create(user=self.user, gender='Male', region='region', city='city',
+                                              type='Treating', group=[])
+
+    def tearDown(self):
+        hub.stop()
+
+    def connect(self, token):
+        return ApplicationCommunicator(application, {
+            'type': 'websocket',
+            'path': EVENTS_PATH,
+            'query_string': ('token=%s' % token).encode(),
+            'headers': [],
+        })
+
+    @async_to_sync
+    async def receive_events(self, action):
+        communicator = self.connect(self.user.token)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output(5))['type'], 'websocket.accept')
+        await sync_to_async(hub.listening.wait)(5)
+
+        await sync_to_async(action)()
+        message = await communicator.receive_output(5)
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(5)
+        return json.loads(message['text'])
+
+    def test_notification(self):
+        event = self.receive_events(lambda: Notification.objects.create(
+            user=self.user, name='name', description='description', source='source', status='Not Sended'))
+        self.assertEqual(event['type'], 'notification')
+        self.assertEqual(event['id'], Notification.objects.get().pk)
+        self.assertNotIn('description', event)
+
+    def test_record(self):
+        now = datetime.datetime(2021, 5, 3, 10, tzinfo=datetime.timezone.utc)
+        record = Record.objects.create(name='record', patient=self.patient, date_start=now,
+                                       date_end=now + datetime.timedelta(minutes=30))
+
+        def finish():
+            record.done = True
+            record.save()
+
+        event = self.receive_events(finish)
+        self.assertEqual(event['type'], 'record')
+        self.assertEqual(event['id'], record.pk)
+        self.assertTrue(event['done'])
+
+    @async_to_sync
+    async def test_invalid_token(self):
+        communicator = self.connect('invalid')
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(5), {'type': 'websocket.close', 'code': 4401})
+
+
+class PublishTests(APITestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Patient',
+            password='user1password',
+        )
+
+    def test_long_notification(self):
+        notification = Notification.objects.create(
+            user=self.user, name='name', description='d' * 10000, source='source', status='Not Sended')
+        self.assertEqual(Notification.objects.get(pk=notification.pk).description, 'd' * 10000)
+
+    def test_failed_notify(self):
+        # Слишком длинное событие NOTIFY отклоняет, но транзакция продолжается
+        with self.assertLogs('medAppApi.events', 'ERROR'):
+            publish([self.user.pk], {'type': 'test', 'data': 'd' * 10000})
+        self.assertTrue(UserProfile.objects.filter(pk=self.user.pk).exists())
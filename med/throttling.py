@@ -0,0 +1,225 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+
+class BucketStore:
+    """
+    Хранилище token bucket'ов в отображаемом в память файле. Все процессы на
+    хосте открывают один и тот же файл, а изменения выполняются под
+    блокировкой flock, поэтому лимиты общие для всех воркеров без Redis.
+
+    Файл состоит из двух областей фиксированного размера:
+        - счетчики: пары (хеш имени, значение);
+        - корзины: тройки (хеш ключа, токены, время обновления).
+    Корзина ищется по хешу ключа с короткой линейной пробой. Если все слоты
+    пробы заняты, вытесняется корзина, которая дольше всего не обновлялась;
+    вытесненный ключ при следующем запросе получает полную корзину.
+    """
+
+    COUNTER = struct.Struct('<QQ')
+    BUCKET = struct.Struct('<Qdd')
+    COUNTER_SLOTS = 64
+    PROBE = 4
+
+    def __init__(self, path, slots):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self.configure(path, slots)
+
+    def configure(self, path, slots):
+        """ Переключает хранилище на другой файл; он откроется при следующем обращении. """
+        with self._lock:
+            if self._pid == os.getpid():
+                self._map.close()
+                os.close(self._fd)
+            self.path = path
+            self.slots = slots
+            self.size = self.COUNTER.size * self.COUNTER_SLOTS + self.BUCKET.size * slots
+            self._pid = None
+            self._fd = None
+            self._map = None
+
+    def consume(self, key, rate, capacity):
+        """
+        Забирает один токен из корзины key, которая пополняется со скоростью
+        rate токенов в секунду до capacity. Возвращает пару (разрешено,
+        сколько секунд ждать следующего токена).
+        """
+        key_hash = self._hash(key)
+        now = time.time()
+
+        with self._locked() as buf:
+            offset = self._find_bucket(buf, key_hash)
+            stored_hash, tokens, updated_at = self.BUCKET.unpack_from(buf, offset)
+            if stored_hash != key_hash:
+                tokens, updated_at = capacity, now
+
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.BUCKET.pack_into(buf, offset, key_hash, tokens, now)
+
+        wait = 0 if allowed else (1 - tokens) / rate
+        return allowed, wait
+
+    def incr(self, name, delta=1):
+        name_hash = self._hash(name)
+        with self._locked() as buf:
+            offset = self._find_counter(buf, name_hash)
+            if offset is None:
+                return
+            stored_hash, value = self.COUNTER.unpack_from(buf, offset)
+            if stored_hash != name_hash:
+                value = 0
+            self.COUNTER.pack_into(buf, offset, name_hash, value + delta)
+
+    def get(self, name):
+        name_hash = self._hash(name)
+        with self._locked() as buf:
+            offset = self._find_counter(buf, name_hash)
+            if offset is None:
+                return 0
+            stored_hash, value = self.COUNTER.unpack_from(buf, offset)
+            return value if stored_hash == name_hash else 0
+
+    def clear(self):
+        with self._locked() as buf:
+            buf[:] = bytes(self.size)
+
+    def _find_bucket(self, buf, key_hash):
+        base = self.COUNTER.size * self.COUNTER_SLOTS
+        start = key_hash % self.slots
+        oldest_offset, oldest_time = None, None
+
+        for i in range(self.PROBE):
+            offset = base + self.BUCKET.size * ((start + i) % self.slots)
+            stored_hash, _, updated_at = self.BUCKET.unpack_from(buf, offset)
+            if stored_hash == key_hash or stored_hash == 0:
+                return offset
+            if oldest_time is None or updated_at < oldest_time:
+                oldest_offset, oldest_time = offset, updated_at
+
+        return oldest_offset
+
+    def _find_counter(self, buf, name_hash):
+        start = name_hash % self.COUNTER_SLOTS
+        for i in range(self.COUNTER_SLOTS):
+            offset = self.COUNTER.size * ((start + i) % self.COUNTER_SLOTS)
+            stored_hash, _ = self.COUNTER.unpack_from(buf, offset)
+            if stored_hash == name_hash or stored_hash == 0:
+                return offset
+        return None
+
+    def _hash(self, key):
+        value = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        # Нулевой хеш обозначает пустой слот
+        return value or 1
+
+    def _open(self):
+        # После fork дескриптор и отображение нужно открыть заново
+        if self._pid == os.getpid():
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+bucket_store = BucketStore(
+    path=getattr(settings, 'THROTTLE_STORE_PATH', os.path.join(tempfile.gettempdir(), 'medapp-throttle.bin')),
+    slots=getattr(settings, 'THROTTLE_STORE_SLOTS', 65536),
+)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Ограничение частоты запросов по алгоритму token bucket. Скорость берется
+    из DEFAULT_THROTTLE_RATES по scope в формате DRF ('10/min'): корзина
+    вмещает 10 токенов и полностью пополняется за минуту.
+    """
+
+    scope = None
+    store = bucket_store
+
+    def __init__(self):
+        num, period = api_settings.DEFAULT_THROTTLE_RATES[self.scope].split('/')
+        duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+        self.capacity = int(num)
+        self.rate = self.capacity / duration
+        self.wait_time = None
+
+    def get_key(self, request, view):
+        # По умолчанию корзина своя у каждого IP адреса
+        return self.get_ident(request)
+
+    def allow_request(self, request, view):
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+
+        allowed, self.wait_time = self.store.consume('%s:%s' % (self.scope, key), self.rate, self.capacity)
+        self.store.incr('%s:%s' % (self.scope, 'allowed' if allowed else 'rejected'))
+        return allowed
+
+    def wait(self):
+        return self.wait_time
+
+    @classmethod
+    def metrics(cls):
+        return {
+            'allowed': cls.store.get('%s:allowed' % cls.scope),
+            'rejected': cls.store.get('%s:rejected' % cls.scope),
+        }
+
+
+class AuthIPThrottle(TokenBucketThrottle):
+    scope = 'auth_ip'
+
+
+class AuthEmailThrottle(TokenBucketThrottle):
+    scope = 'auth_email'
+
+    def get_key(self, request, view):
+        # Вход и регистрация принимают данные в пространстве имен 'user'
+        user = request.data.get('user', None) if isinstance(request.data, dict) else None
+        if not isinstance(user, dict):
+            return None
+
+        email = user.get('email', None)
+        if not isinstance(email, str) or not email:
+            return None
+        return email.strip().lower()
@@ -5,10 +5,14 @@ from .views import *
 urlpatterns = [
     path('registration', RegistrationAPIView.as_view(), name='registration'),  # post регистрация
     path('users/login', LoginAPIView.as_view(), name='login'),  # post вход
+    path('users/token/refresh', TokenRefreshAPIView.as_view(), name='token-refresh'),  # post новый токен
     path('users', UserProfileListCreateView.as_view()),  #
+    path('metrics', MetricsAPIView.as_view(), name='metrics'),
+    path('notifications/summary', NotificationSummaryView.as_view(), name='notifications-summary'),  # непрочитанные
     path('patients', PatientListCreateView.as_view()),
     path('medics', MedPersobaListCreateView.as_view()),
     path('medics/<int:pk>/servicemedper', ServiceMedPersonaByMedicView.as_view()),
+    path('medics/<int:pk>/availability', MedPersonaAvailabilityView.as_view(), name='availability'),  # свободные слоты
     path('admins', AdminListCreateView.as_view()),
     path('passports', PassportDataView.as_view()),
     path('passports/<int:pk>', SinglePassportDataView.as_view()),
@@ -28,6 +32,8 @@ urlpatterns = [
     path('sanatorium/<int:pk>', SingleSanatoriumView.as_view()),
     path('timetable', TimetableView.as_view()),
     path('timetable/<int:pk>', SingleTimeTableView.as_view()),
+    path('schedule-rules', ScheduleRuleView.as_view(), name='schedule-rules'),
+    path('schedule-rules/<int:pk>', SingleScheduleRuleView.as_view()),
     path('service', ServiceView.as_view()),
     path('service/<int:pk>', SingleServiceView.as_view()),
     path('service/<int:pk>/servicemedper', ServiceMedPersonaByServiceView.as_view()),
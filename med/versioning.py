@@ -0,0 +1,159 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+from .models import ModelVersion
+
+VERSION_KEY = 'version:%s'
+RESPONSE_KEY = 'response:%s'
+METRIC_KEY = 'metric:%s'
+
+
+def get_catalog_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_versions(models_list):
+    """
+    Возвращает {label: (версия, время изменения)} для перечисленных моделей.
+    Версии читаются из кэша справочников, а отсутствующие в нем - одним
+    запросом к ModelVersion.
+    """
+    cache = get_catalog_cache()
+    labels = [model._meta.label_lower for model in models_list]
+    cached = cache.get_many([VERSION_KEY % label for label in labels])
+
+    versions = {label: cached[VERSION_KEY % label] for label in labels if VERSION_KEY % label in cached}
+    missing = [model for model in models_list if model._meta.label_lower not in versions]
+    if missing:
+        loaded = ModelVersion.objects.versions(missing)
+        for model in missing:
+            label = model._meta.label_lower
+            versions[label] = loaded.get(label, (0, None))
+            cache.add(VERSION_KEY % label, versions[label], getattr(settings, 'CATALOG_VERSION_TTL', 60))
+    return versions
+
+
+def bump_version(model):
+    """
+    Увеличивает версию модели. Все ключи кэша, построенные на старой версии,
+    перестают использоваться, перебирать и удалять их не нужно.
+    """
+    ModelVersion.objects.bump(model)
+
+    # Закэшированную версию сбрасываем сразу и еще раз после фиксации
+    # транзакции, иначе параллельный запрос может положить в кэш версию,
+    # прочитанную до фиксации.
+    key = VERSION_KEY % model._meta.label_lower
+    get_catalog_cache().delete(key)
+    transaction.on_commit(lambda: get_catalog_cache().delete(key))
+
+
+def incr_metric(name):
+    # Счетчики хранятся в кэше справочников: общие для процессов, если
+    # бэкенд общий, и процессные для LocMemCache
+    cache = get_catalog_cache()
+    key = METRIC_KEY % name
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Счетчика еще нет или он вытеснен
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def cache_metrics():
+    values = get_catalog_cache().get_many([METRIC_KEY % 'hit', METRIC_KEY % 'miss'])
+    return {
+        'hit': values.get(METRIC_KEY % 'hit', 0),
+        'miss': values.get(METRIC_KEY % 'miss', 0),
+    }
+
+
+class ConditionalGetMixin:
+    """
+    Условный GET для справочных представлений. ETag и Last-Modified
+    вычисляются по версиям моделей из conditional_models, и если клиент
+    прислал совпадающий If-None-Match или If-Modified-Since, отвечаем 304
+    без обращения к основной выборке.
+
+    В conditional_models нужно перечислить все модели, от которых зависит
+    ответ, включая используемые фильтрами.
+    """
+
+    conditional_models = ()
+
+    def get(self, request, *args, **kwargs):
+        self.etag, self.last_modified = self.get_validators()
+
+        response = get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+        if response is None:
+            response = self.get_response(request, *args, **kwargs)
+
+        if response.status_code in (200, 304):
+            response['ETag'] = self.etag
+            if self.last_modified is not None:
+                response['Last-Modified'] = http_date(self.last_modified)
+        return response
+
+    def get_response(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_validators(self):
+        versions = get_versions(self.conditional_models)
+
+        # Время изменения тоже входит в ETag: после восстановления базы из
+        # копии номера версий могут повториться.
+        state = ';'.join(
+            '%s:%d:%s' % (label, version, modified_at.timestamp() if modified_at else '')
+            for label, (version, modified_at) in sorted(versions.items())
+        )
+        etag = 'W/"%s"' % hashlib.md5(state.encode('utf-8')).hexdigest()
+
+        modified = [modified_at for _, modified_at in versions.values() if modified_at is not None]
+        last_modified = int(max(modified).timestamp()) if modified else None
+        # Last-Modified точен до секунды. Пока секунда последнего изменения
+        # не закончилась, в ней возможны новые изменения с тем же значением,
+        # и клиент с If-Modified-Since получил бы 304 со старыми данными,
+        # поэтому в это время отдается только ETag.
+        if last_modified is not None and last_modified >= int(time.time()):
+            last_modified = None
+        return etag, last_modified
+
+
+class CachedResponseMixin(ConditionalGetMixin):
+    """
+    Кэширует данные ответа GET в кэше справочников (CATALOG_CACHE_ALIAS).
+    Ключ строится из ETag, то есть из версий моделей, и полного адреса
+    запроса, поэтому после изменения модели старые записи просто перестают
+    запрашиваться и со временем вытесняются бэкендом кэша.
+
+    Подходит только для ответов, не зависящих от пользователя.
+    """
+
+    response_cache_timeout = 3600
+
+    def get_response(self, request, *args, **kwargs):
+        cache = get_catalog_cache()
+        # В адресе учитываются хост и параметры запроса: от них зависят
+        # ссылки пагинации, фильтры и набор полей
+        key = '%s %s' % (self.etag, request.build_absolute_uri())
+        key = RESPONSE_KEY % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+        data = cache.get(key)
+        if data is not None:
+            incr_metric('hit')
+            return Response(data)
+
+        incr_metric('miss')
+        response = super().get_response(request, *args, **kwargs)
+        # Потоковые ответы не кэшируются
+        if response.status_code == 200 and getattr(response, 'data', None) is not None:
+            cache.set(key, response.data, self.response_cache_timeout)
+        return response
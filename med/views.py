@@ -10,20 +10,21 @@ from rest_framework.views import APIView
 from rest_framework import status, viewsets
 from .serializers import *
 from .renderers import *
-from rest_framework.renderers import JSONRenderer
 from .filters import *
+from medAppApi.streaming import StreamingListMixin
+from medAppApi.sparse_fields import SparseFieldsetFilter, FIELDS_QUERY_PARAM, EXCLUDE_QUERY_PARAM
+from .hashing import hashing_pool
+from .availability import get_availability
+from .versioning import ConditionalGetMixin, CachedResponseMixin, cache_metrics
+from .throttling import AuthIPThrottle, AuthEmailThrottle
 
 
-class UserProfileListCreateView(ListCreateAPIView):
+class UserProfileListCreateView(StreamingListMixin, ListCreateAPIView):
     queryset = UserProfile.objects.all()
     serializer_class = UserProfileSerializer
     permission_classes = [IsAuthenticated, IsUserAdmin]
 
-    renderer_classes = (JSONRenderer,)
-
-    def get(self, request, *args, **kwargs):
-        serializer = self.serializer_class(self.get_queryset(), many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    renderer_classes = (FastJSONRenderer,)
 
     def perform_create(self, serializer):
         user = self.request.user
@@ -54,26 +55,27 @@ class UserProfileDetailView(RetrieveUpdateDestroyAPIView):
 class PatientDetailView(RetrieveUpdateDestroyAPIView):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
 
 
 class AdminProfileDetailView(RetrieveUpdateDestroyAPIView):
     queryset = Admin.objects.all()
     serializer_class = AdminSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
 
 
 class MedPersonaDetailView(RetrieveUpdateDestroyAPIView):
     queryset = MedPersona.objects.all()
     serializer_class = MedPeronaSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
 
 
 class RegistrationAPIView(APIView):
     permission_classes = (AllowAny,)
+    throttle_classes = (AuthIPThrottle, AuthEmailThrottle)
     serializer_classes = RegistrationSerializer
     renderer_classes = (UserJSONRenderer,)
 
@@ -91,6 +93,7 @@ class RegistrationAPIView(APIView):
 
 class LoginAPIView(APIView):
     permission_classes = (AllowAny,)
+    throttle_classes = (AuthIPThrottle, AuthEmailThrottle)
     renderer_classes = (UserJSONRenderer,)
     serializer_class = LoginSerializer
 
@@ -110,31 +113,95 @@ class LoginAPIView(APIView):
         return Response(data, status=status.HTTP_200_OK)
 
 
+class TokenRefreshAPIView(APIView):
+    permission_classes = (AllowAny,)
+    renderer_classes = (UserJSONRenderer,)
+    serializer_class = TokenRefreshSerializer
+
+    def get_authenticate_header(self, request):
+        # Отозванный refresh токен - ошибка аутентификации: 401, а не 403
+        return 'Bearer'
+
+    def post(self, request):
+        user = request.data.get('user', {})
+
+        # Пароль здесь не проверяется: достаточно действующего refresh токена,
+        # который при этом заменяется новым.
+        serializer = self.serializer_class(data=user)
+        serializer.is_valid(raise_exception=True)
+
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class MetricsAPIView(APIView):
+    permission_classes = [IsAuthenticated, IsUserAdmin]
+    renderer_classes = (FastJSONRenderer,)
+
+    def get(self, request):
+        # Счетчики процесса, обработавшего запрос
+        data = {
+            'password_hashing': hashing_pool.metrics(),
+            # Счетчики ограничителя общие для всех процессов хоста
+            'throttling': {
+                throttle.scope: throttle.metrics() for throttle in (AuthIPThrottle, AuthEmailThrottle)
+            },
+            'catalog_cache': cache_metrics(),
+        }
+        return Response(data, status=status.HTTP_200_OK)
+
+
 class MedPersobaListCreateView(ListCreateAPIView):
     queryset = MedPersona.objects.all()
     serializer_class = MedPeronaSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
+    permission_classes = [IsAuthenticated]
+
+
+class MedPersonaAvailabilityView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = (FastJSONRenderer,)
+
+    def get(self, request, *args, **kwargs):
+        serializer = AvailabilityQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        if not MedPersona.objects.filter(pk=kwargs['pk']).exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        slots = get_availability(kwargs['pk'], params['from'], params['to'], params.get('service'))
+        return Response(slots, status=status.HTTP_200_OK)
+
+
+class NotificationSummaryView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = (FastJSONRenderer,)
+
+    def get(self, request):
+        # Счетчик читается по первичному ключу вместо COUNT(*) по уведомлениям.
+        # Строки нет, пока у пользователя не было уведомлений.
+        unread = NotificationCounter.objects.filter(user_id=request.user.pk).values_list('unread', flat=True).first()
+        return Response({'unread': unread or 0}, status=status.HTTP_200_OK)
 
 
 class PatientListCreateView(ListCreateAPIView):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
 
 
 class AdminListCreateView(ListCreateAPIView):
     queryset = Admin.objects.all()
     serializer_class = AdminSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
 
 
 class UserRetrieveUpdateAPIView(RetrieveUpdateAPIView):
     permission_classes = (IsAuthenticated,)
     renderer_classes = (UserJSONRenderer,)
-    # renderer_classes = (JSONRenderer,)
+    # renderer_classes = (FastJSONRenderer,)
     serializer_class = UserSerializer
 
     def retrieve(self, request, *args, **kwargs):
@@ -168,7 +235,7 @@ class UserRetrieveUpdateAPIView(RetrieveUpdateAPIView):
 
 class MedPersonaAPIView(APIView):
     serializer_class = MedPeronaSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsOwnerProfileOrReadOnly, IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
@@ -199,7 +266,7 @@ class MedPersonaAPIView(APIView):
 
 class PatientAPIView(APIView):
     serializer_class = PatientSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsOwnerProfileOrReadOnly, IsAuthenticated, IsUserPatient]
 
     def get(self, request, *args, **kwargs):
@@ -231,7 +298,7 @@ class PatientAPIView(APIView):
 
 class AdminAPIView(APIView):
     serializer_class = AdminSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsOwnerProfileOrReadOnly, IsAuthenticated, IsUserAdmin]
 
     def get(self, request, *args, **kwargs):
@@ -263,7 +330,7 @@ class AdminAPIView(APIView):
 
 class PassportDataAPIView(APIView):
     serializer_class = PassportDataSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsOwnerProfileOrReadOnly, IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
@@ -295,7 +362,7 @@ class PassportDataAPIView(APIView):
 
 class PassportDataByUserAPIView(APIView):
     serializer_class = PassportDataSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
@@ -308,64 +375,86 @@ class PassportDataByUserAPIView(APIView):
 class PassportDataView(ListCreateAPIView):
     queryset = PassportData.objects.all()
     serializer_class = PassportDataSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
 
 class SinglePassportDataView(RetrieveUpdateDestroyAPIView):
     queryset = PassportData.objects.all()
     serializer_class = PassportDataSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
 
-class SanatoriumView(ListCreateAPIView):
+class SanatoriumView(CachedResponseMixin, ListCreateAPIView):
     queryset = Sanatorium.objects.all()
     serializer_class = SanatoriumSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Sanatorium,)
 
 
-class SingleSanatoriumView(RetrieveUpdateDestroyAPIView):
+class SingleSanatoriumView(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Sanatorium.objects.all()
     serializer_class = SanatoriumSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Sanatorium,)
 
 
-class TimetableView(ListCreateAPIView):
-    queryset = TimeTable.objects.all()
+class TimetableView(ConditionalGetMixin, ListCreateAPIView):
+    queryset = TimeTable.objects.with_slot_dates()
     serializer_class = TimeTableSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
     filterset_class = TimetableFilter
+    conditional_models = (TimeTable,)
 
 
-class SingleTimeTableView(RetrieveUpdateDestroyAPIView):
-    queryset = TimeTable.objects.all()
+class SingleTimeTableView(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
+    queryset = TimeTable.objects.with_slot_dates()
     serializer_class = TimeTableSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (TimeTable,)
 
 
-class ServiceView(ListCreateAPIView):
+class ServiceView(CachedResponseMixin, ListCreateAPIView):
     queryset = Service.objects.all()
     serializer_class = ServiceSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
     filterset_class = ServiceFilter
+    conditional_models = (Service,)
 
 
-class SingleServiceView(RetrieveUpdateDestroyAPIView):
+class SingleServiceView(CachedResponseMixin, RetrieveUpdateDestroyAPIView):
     queryset = Service.objects.all()
     serializer_class = ServiceSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Service,)
+
+
+class ScheduleRuleView(ListCreateAPIView):
+    queryset = ScheduleRule.objects.all()
+    serializer_class = ScheduleRuleSerializer
+    renderer_classes = [FastJSONRenderer]
+    permission_classes = [IsAuthenticated, IsUserAdmin]
+    filter_backends = [DjangoFilterBackend, SparseFieldsetFilter]
+    filterset_fields = ('service', 'medpersona')
+
+
+class SingleScheduleRuleView(RetrieveUpdateDestroyAPIView):
+    queryset = ScheduleRule.objects.all()
+    serializer_class = ScheduleRuleSerializer
+    renderer_classes = [FastJSONRenderer]
+    permission_classes = [IsAuthenticated, IsUserAdmin]
 
 
 class ServiceMedPersonaView(ListCreateAPIView):
     queryset = ServiceMedPersona.objects.all()
     serializer_class = ServiceMedPersonaSerializer
-    renderer_classes = [JSONRenderer]
-    filter_backends = [DjangoFilterBackend]
+    renderer_classes = [FastJSONRenderer]
+    filter_backends = [DjangoFilterBackend, SparseFieldsetFilter]
     filterset_fields = '__all__'
 
 
 class ServiceMedPersonaViewByIdIn(APIView):
     serializer_class = ServiceMedPersonaSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     def get(self, request):
         medpersona = request.data.get('medpersona', {})
@@ -401,26 +490,23 @@ class ServiceMedPersonaViewByIdIn(APIView):
 class SingleServiceMedPersonaView(RetrieveUpdateDestroyAPIView):
     queryset = ServiceMedPersona.objects.all()
     serializer_class = ServiceMedPersonaSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
 
 class ServiceMedPersonaByServiceView(ListCreateAPIView):
     queryset = ServiceMedPersona.objects.all()
     serializer_class = ServiceMedPersonaSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, *args, **kwargs):
-        servicemedpers = ServiceMedPersona.objects.filter(service=kwargs['pk'])
-        serializer = self.serializer_class(servicemedpers, many=True)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    def get_queryset(self):
+        return ServiceMedPersona.objects.filter(service=self.kwargs['pk'])
 
 
 class ServiceMedPersonaByMedicView(ListCreateAPIView):
     queryset = ServiceMedPersona.objects.all()
     serializer_class = ServiceMedPersonaSerializer
-    renderer_classes = (JSONRenderer,)
+    renderer_classes = (FastJSONRenderer,)
     permission_classes = [IsAuthenticated]
     filterset_class = ServiceMedPersonaFilter
 
@@ -434,14 +520,11 @@ class ServiceMedPersonaByMedicView(ListCreateAPIView):
     #     return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class ProcedureView(ListCreateAPIView):
+class ProcedureView(CachedResponseMixin, StreamingListMixin, ListCreateAPIView):
     queryset = Procedure.objects.all()
     serializer_class = ProcedureSerializer
-    renderer_classes = [JSONRenderer]
-
-    def get(self, request, *args, **kwargs):
-        serializer = self.serializer_class(self.get_queryset(), many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Procedure,)
 
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data)
@@ -450,10 +533,11 @@ class ProcedureView(ListCreateAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SingleProcedureView(RetrieveUpdateDestroyAPIView):
+class SingleProcedureView(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Procedure.objects.all()
     serializer_class = ProcedureSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Procedure,)
 
     def retrieve(self, request, *args, **kwargs):
         procedure = get_object_or_404(Procedure, id=kwargs['pk'])
@@ -462,10 +546,11 @@ class SingleProcedureView(RetrieveUpdateDestroyAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SingleProcedureViewByService(RetrieveUpdateDestroyAPIView):
+class SingleProcedureViewByService(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Procedure.objects.all()
     serializer_class = ProcedureSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Procedure,)
 
     def retrieve(self, request, *args, **kwargs):
         procedure = get_object_or_404(Procedure, service=kwargs['pk'])
@@ -474,14 +559,11 @@ class SingleProcedureViewByService(RetrieveUpdateDestroyAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SurveyView(ListCreateAPIView):
+class SurveyView(CachedResponseMixin, StreamingListMixin, ListCreateAPIView):
     queryset = Survey.objects.all()
     serializer_class = SurveySerializer
-    renderer_classes = [JSONRenderer]
-
-    def get(self, request, *args, **kwargs):
-        serializer = self.serializer_class(self.get_queryset(), many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Survey,)
 
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data)
@@ -490,10 +572,11 @@ class SurveyView(ListCreateAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SingleSurveyView(RetrieveUpdateDestroyAPIView):
+class SingleSurveyView(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Survey.objects.all()
     serializer_class = SurveySerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Survey,)
 
     def retrieve(self, request, *args, **kwargs):
         survey = get_object_or_404(Survey, id=kwargs['pk'])
@@ -502,10 +585,11 @@ class SingleSurveyView(RetrieveUpdateDestroyAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SingleSurveyViewByService(RetrieveUpdateDestroyAPIView):
+class SingleSurveyViewByService(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Survey.objects.all()
     serializer_class = SurveySerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Survey,)
 
     def retrieve(self, request, *args, **kwargs):
         survey = get_object_or_404(Survey, service=kwargs['pk'])
@@ -514,22 +598,25 @@ class SingleSurveyViewByService(RetrieveUpdateDestroyAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SpecialityView(ListCreateAPIView):
+class SpecialityView(CachedResponseMixin, ListCreateAPIView):
     queryset = Speciality.objects.all()
     serializer_class = SpecialitySerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Speciality,)
 
 
-class SingleSpecialityView(RetrieveUpdateDestroyAPIView):
+class SingleSpecialityView(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Speciality.objects.all()
     serializer_class = SpecialitySerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Speciality,)
 
 
-class SingleSpecialityViewByService(RetrieveUpdateDestroyAPIView):
+class SingleSpecialityViewByService(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Speciality.objects.all()
     serializer_class = SpecialitySerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Speciality,)
 
     def retrieve(self, request, *args, **kwargs):
         speciality = get_object_or_404(Speciality, service=kwargs['pk'])
@@ -538,14 +625,11 @@ class SingleSpecialityViewByService(RetrieveUpdateDestroyAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class EventView(ListCreateAPIView):
+class EventView(CachedResponseMixin, StreamingListMixin, ListCreateAPIView):
     queryset = Event.objects.all()
     serializer_class = EventSerializer
-    renderer_classes = [JSONRenderer]
-
-    def get(self, request, *args, **kwargs):
-        serializer = self.serializer_class(self.get_queryset(), many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Event,)
 
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data)
@@ -554,10 +638,11 @@ class EventView(ListCreateAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SingleEventView(RetrieveUpdateDestroyAPIView):
+class SingleEventView(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Event.objects.all()
     serializer_class = EventSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Event,)
 
     def retrieve(self, request, *args, **kwargs):
         event = get_object_or_404(Event, id=kwargs['pk'])
@@ -566,10 +651,11 @@ class SingleEventView(RetrieveUpdateDestroyAPIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class SingleEventViewByService(RetrieveUpdateDestroyAPIView):
+class SingleEventViewByService(ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Event.objects.all()
     serializer_class = EventSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    conditional_models = (Event,)
 
     def retrieve(self, request, *args, **kwargs):
         event = get_object_or_404(Event, service=kwargs['pk'])
@@ -581,7 +667,7 @@ class SingleEventViewByService(RetrieveUpdateDestroyAPIView):
 class MedCardView(CreateAPIView, RetrieveUpdateAPIView):
     queryset = Medcard.objects.all()
     serializer_class = MedcardSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     permission_classes = [IsAuthenticated]
 
@@ -617,23 +703,24 @@ class MedPersonaPatientAPIView(ListCreateAPIView, DestroyAPIView):
     serializer_class = MedPersonaPatientSerializer
     permission_classes = [IsAuthenticated]
 
-    renderer_classes = (JSONRenderer,)
-    filter_backends = [DjangoFilterBackend]
+    renderer_classes = (FastJSONRenderer,)
+    filter_backends = [DjangoFilterBackend, SparseFieldsetFilter]
     filter_fields = ('patient', 'medpersona', 'id')
 
     def get(self, request, *args, **kwargs):
         qs = self.queryset.none()
-        if not request.query_params:
-            qs = MedPersonaPatient.objects.all()
-            serializer_data = self.serializer_class(qs,many=True)
-
-            return Response(data=serializer_data.data, status=status.HTTP_200_OK)
-        elif set(request.query_params.dict().keys()).issubset(list(self.filter_fields)):
+        # Параметры пагинации и выбора полей не относятся к фильтрам
+        params = set(request.query_params.dict().keys()) - {
+            self.paginator.cursor_query_param,
+            self.paginator.page_size_query_param,
+            FIELDS_QUERY_PARAM,
+            EXCLUDE_QUERY_PARAM,
+        }
+        if not params:
+            return self.list(request, *args, **kwargs)
+        elif params.issubset(list(self.filter_fields)):
             try:
-                qs_ = self.filter_queryset(self.get_queryset())
-                serializer_data = self.serializer_class(qs_, many=True)
-
-                return Response(data=serializer_data.data, status=status.HTTP_200_OK)
+                return self.list(request, *args, **kwargs)
             except Exception as e:
                 return Response(data=qs, status=status.HTTP_406_NOT_ACCEPTABLE)
         else:
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+from urllib.parse import parse_qs
+
+import jwt
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, connections, transaction, DatabaseError, DEFAULT_DB_ALIAS
+from rest_framework import exceptions
+
+from med.backends import JWTAuthentication
+from med.renderers import dumps
+
+logger = logging.getLogger(__name__)
+
+# Канал Postgres LISTEN/NOTIFY, по которому события доходят до хаба
+EVENTS_CHANNEL = 'med_events'
+EVENTS_PATH = '/ws/events'
+
+
+def publish(user_ids, event):
+    """
+    Отправляет событие пользователям user_ids. Событие передается через
+    NOTIFY, поэтому доходит до хабов всех процессов (в том числе из
+    management команд), а при откате транзакции не отправляется вовсе:
+    Postgres доставляет NOTIFY только после фиксации.
+
+    События должны быть короткими (NOTIFY принимает не больше 8000 байт),
+    содержимое клиент получает через API. Ошибка отправки только
+    логируется: NOTIFY выполняется в savepoint и не откатывает изменения,
+    о которых сообщает событие.
+    """
+    payloads = [dumps({'user': user_id, 'event': event}).decode('utf-8') for user_id in set(user_ids)]
+    if not payloads:
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload',
+                           [EVENTS_CHANNEL, payloads])
+    except DatabaseError:
+        logger.exception('Не удалось отправить событие %s', event.get('type'))
+
+
+class EventHub:
+    """
+    Процессный pub/sub: раздает события подключенным клиентам по
+    пользователям. У каждого подключения своя ограниченная очередь, при
+    переполнении из нее выбрасываются самые старые события, поэтому
+    медленный клиент не увеличивает память процесса. События читаются
+    одним фоновым потоком, который слушает EVENTS_CHANNEL.
+    """
+
+    def __init__(self, queue_size=100, poll_timeout=1.0):
+        self.queue_size = queue_size
+        self.poll_timeout = poll_timeout
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._listener = None
+        self._stopped = threading.Event()
+        # Установлен, пока поток подписан на канал
+        self.listening = threading.Event()
+
+    def subscribe(self, user_id):
+        """ Возвращает очередь событий пользователя для текущего event loop. """
+        queue = asyncio.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add((asyncio.get_running_loop(), queue))
+        self.start()
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.difference_update({item for item in subscribers if item[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def dispatch(self, user_id, event):
+        """ Передает событие всем подключениям пользователя. Вызывается из любого потока. """
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self._put, queue, event)
+
+    @staticmethod
+    def _put(queue, event):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    def start(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._stopped.clear()
+            self._listener = threading.Thread(target=self.listen, name='event-hub', daemon=True)
+            self._listener.start()
+
+    def stop(self):
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            self._stopped.set()
+            listener.join()
+
+    def listen(self):
+        # Соединение потока отдельное от соединений запросов
+        db = connections[DEFAULT_DB_ALIAS]
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self._listen(db)
+                except Exception:
+                    self.listening.clear()
+                    logger.exception('Ошибка чтения канала событий')
+                    db.close()
+                    self._stopped.wait(self.poll_timeout)
+        finally:
+            self.listening.clear()
+            db.close()
+
+    def _listen(self, db):
+        db.ensure_connection()
+        with db.cursor() as cursor:
+            cursor.execute('LISTEN %s' % EVENTS_CHANNEL)
+        raw = db.connection
+        self.listening.set()
+
+        while not self._stopped.is_set():
+            if not select.select([raw], [], [], self.poll_timeout)[0]:
+                continue
+            raw.poll()
+            while raw.notifies:
+                payload = json.loads(raw.notifies.pop(0).payload)
+                self.dispatch(payload['user'], payload['event'])
+
+
+hub = EventHub()
+
+
+def get_token(scope):
+    """
+    Токен доступа из заголовка Authorization: Bearer или, так как браузерный
+    WebSocket не умеет передавать заголовки, из параметра ?token=.
+    """
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            parts = value.decode('latin-1').split()
+            if len(parts) == 2 and parts[0].lower() == JWTAuthentication.authentication_header_prefix:
+                return parts[1]
+    return parse_qs(scope.get('query_string', b'').decode('latin-1')).get('token', [None])[0]
+
+
+def authenticate(token):
+    """ Возвращает пользователя и время истечения токена. """
+    user, token = JWTAuthentication().authenticate_credentials(None, token)
+    payload = jwt.decode(token, settings.SECRET_KEY, algorithms='HS256')
+    return user, payload['exp']
+
+
+async def websocket_application(scope, receive, send):
+    """
+    WebSocket EVENTS_PATH: после подключения клиент получает JSON события
+    своего пользователя. Соединение закрывается с кодом 4401, если токен
+    недействителен или истек.
+    """
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if scope['path'] != EVENTS_PATH:
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    token = get_token(scope)
+    try:
+        if token is None:
+            raise exceptions.AuthenticationFailed()
+        user, expires_at = await sync_to_async(authenticate)(token)
+    except exceptions.AuthenticationFailed:
+        await send({'type': 'websocket.close', 'code': 4401})
+        return
+
+    await send({'type': 'websocket.accept'})
+    queue = hub.subscribe(user.pk)
+
+    async def push():
+        while True:
+            event = await queue.get()
+            await send({'type': 'websocket.send', 'text': dumps(event).decode('utf-8')})
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = [asyncio.create_task(push()), asyncio.create_task(wait_disconnect())]
+    try:
+        timeout = max(expires_at - time.time(), 0)
+        done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            await send({'type': 'websocket.close', 'code': 4401})
+    finally:
+        hub.unsubscribe(user.pk, queue)
+        for task in tasks:
+            task.cancel()
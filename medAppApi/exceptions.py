@@ -1,5 +1,10 @@
+from rest_framework import status
+from rest_framework.response import Response
 from rest_framework.views import exception_handler
 
+# Код ошибки Postgres при нарушении ограничения-исключения (EXCLUDE)
+EXCLUSION_VIOLATION = '23P01'
+
 
 def core_exception_handler(exc, context):
     # Если возникает исключение, которые мы не обрабатываем здесь явно, мы
@@ -8,7 +13,8 @@ def core_exception_handler(exc, context):
     # доступ к сгенерированному DRF - получим его заранее здесь.
     response = exception_handler(exc, context)
     handlers = {
-        'ValidationError': _handle_generic_error
+        'ValidationError': _handle_generic_error,
+        'IntegrityError': _handle_integrity_error,
     }
     # Определить тип текущего исключения. Мы воспользуемся этим сразу далее,
     # чтобы решить, делать ли это самостоятельно или отдать эту работу DRF.
@@ -27,3 +33,17 @@ def _handle_generic_error(exc, context, response):
     }
 
     return response
+
+
+def _handle_integrity_error(exc, context, response):
+    # DRF не обрабатывает ошибки базы, response здесь None. Пересечение
+    # записей медперсоны отклоняет ограничение в Postgres - это конфликт
+    # с уже существующей записью, а не ошибка сервера.
+    if getattr(exc.__cause__, 'pgcode', None) != EXCLUSION_VIOLATION:
+        return response
+
+    return Response({
+        'errors': {
+            'error': ['Медперсона уже занята в это время.']
+        }
+    }, status=status.HTTP_409_CONFLICT)
@@ -8,16 +8,22 @@ class IsOwnerProfileOrReadOnly(BasePermission):
         return obj.user == request.user
 
 
-class IsUserPatient(BasePermission):
+class HasRole(BasePermission):
+    # При аутентификации по токену с подписанными claims роль берется из
+    # токена, и проверка не загружает пользователя из базы.
+    role = None
+
     def has_permission(self, request, view):
-        return request.user.role == 'Patient'
+        return getattr(request.user, 'role', None) == self.role
 
 
-class IsUserMedic(BasePermission):
-    def has_permission(self, request, view):
-        return request.user.role == 'Doctor'
+class IsUserPatient(HasRole):
+    role = 'Patient'
 
 
-class IsUserAdmin(BasePermission):
-    def has_permission(self, request, view):
-        return request.user.role == 'Admin'
+class IsUserMedic(HasRole):
+    role = 'Doctor'
+
+
+class IsUserAdmin(HasRole):
+    role = 'Admin'
@@ -0,0 +1,203 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import BooleanField, Expression, F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class RowComparison(Expression):
+    """
+    Условие (a, b, ...) > (x, y, ...) (или "<" для сортировки по убыванию)
+    по полям модели. Значения приводятся к типам полей.
+    """
+
+    conditional = True
+
+    def __init__(self, fields, descending):
+        super().__init__(output_field=BooleanField())
+        self.descending = descending
+        self.columns = [F(name) for name, _ in fields]
+        self.values = [value for _, value in fields]
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        c = self.copy()
+        c.columns = [column.resolve_expression(query, allow_joins, reuse, summarize, for_save)
+                     for column in self.columns]
+        return c
+
+    def as_sql(self, compiler, connection):
+        columns, params = [], []
+        for column in self.columns:
+            sql, column_params = compiler.compile(column)
+            columns.append(sql)
+            params += column_params
+        for column, value in zip(self.columns, self.values):
+            params.append(column.output_field.get_db_prep_value(value, connection))
+
+        operator = '<' if self.descending else '>'
+        placeholders = ', '.join(['%s'] * len(self.values))
+        return '(%s) %s (%s)' % (', '.join(columns), operator, placeholders), params
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Постраничная выдача по ключу (keyset). Курсор хранит значения полей
+    сортировки и id последней записи страницы, а следующая страница
+    выбирается условием "после этих значений". В отличие от OFFSET запрос
+    стоит одинаково для любой страницы, если на (поля сортировки, id) есть
+    индекс.
+
+    Сортировка берется из атрибута ordering представления, иначе из
+    Meta.ordering модели; id всегда добавляется последним для однозначности.
+    Поля сортировки не должны допускать NULL.
+
+    Если все поля сортируются в одном направлении, условие записывается
+    сравнением строк (a, b, id) > (x, y, z), которое Postgres использует как
+    начало диапазона в индексе. При смешанных направлениях (например,
+    done, -date_start у Record) одним сравнением строк не обойтись: страница
+    собирается из нескольких запросов по диапазонам индекса, по одному на
+    группу полей одного направления, - сначала done = x AND
+    (date_start, id) < (y, z), затем done > x, - пока она не заполнится.
+
+    Пагинация включается, только если в запросе передан cursor или
+    page_size, - без них представление по-прежнему отдает весь список.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = api_settings.PAGE_SIZE or 50
+    max_page_size = getattr(settings, 'PAGINATION_MAX_PAGE_SIZE', 500)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if (self.cursor_query_param not in request.query_params and
+                self.page_size_query_param not in request.query_params):
+            return None
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset, view)
+        self.model = queryset.model
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is None:
+            results = list(queryset[:self.page_size + 1])
+        else:
+            try:
+                conditions = self.get_position_filters(position)
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+            # Диапазоны идут в порядке сортировки, следующий читается, только
+            # если предыдущих строк не хватило на страницу
+            results = []
+            for condition in conditions:
+                results += queryset.filter(condition)[:self.page_size + 1 - len(results)]
+                if len(results) > self.page_size:
+                    break
+
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_ordering(self, queryset, view):
+        ordering = getattr(view, 'ordering', None) or queryset.model._meta.ordering or []
+        if isinstance(ordering, str):
+            ordering = [ordering]
+
+        ordering = [field for field in ordering if field.lstrip('-') not in ('id', 'pk')]
+        # Направление id совпадает с направлением последнего поля, чтобы
+        # сортировка целиком ложилась на один составной индекс.
+        descending = bool(ordering) and ordering[-1].startswith('-')
+        return list(ordering) + ['-id' if descending else 'id']
+
+    def get_position_filters(self, position):
+        # Поля сортировки делятся на группы подряд идущих полей одного
+        # направления. (a, -b, -id) "после" (x, y, z) раскрывается в
+        # диапазоны a = x AND (b, id) < (y, z) и a > x в порядке сортировки;
+        # при одном направлении остается одно сравнение строк.
+        groups = []
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            value = self.model._meta.get_field(name).to_python(value)
+            descending = field.startswith('-')
+            if groups and groups[-1][0] == descending:
+                groups[-1][1].append((name, value))
+            else:
+                groups.append((descending, [(name, value)]))
+
+        conditions = []
+        equal = []
+        for descending, fields in groups:
+            conditions.append(Q(RowComparison(fields, descending), *equal))
+            equal += [Q(**{name: value}) for name, value in fields]
+        return conditions[::-1]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        last = self.page[-1]
+        position = [self._get_value(last, field.lstrip('-')) for field in self.ordering]
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(position))
+
+    def encode_cursor(self, position):
+        # Даты сохраняются с микросекундами, иначе позиция будет неточной
+        data = json.dumps(position, default=lambda value: value.isoformat(), separators=(',', ':'))
+        return urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            position = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def _get_value(self, instance, name):
+        field = instance._meta.get_field(name)
+        return getattr(instance, field.attname)
@@ -11,7 +11,9 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 from pathlib import Path
+from datetime import timedelta
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -64,7 +66,7 @@ REST_FRAMEWORK = {
         'med.backends.JWTAuthentication',
     ),
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'med.renderers.FastJSONRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
     ],
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
@@ -73,9 +75,27 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_FILTER_BACKENDS': (
         'django_filters.rest_framework.DjangoFilterBackend',
+        'medAppApi.sparse_fields.SparseFieldsetFilter',
     ),
+    # Постраничная выдача по курсору включается параметрами cursor/page_size
+    'DEFAULT_PAGINATION_CLASS': 'medAppApi.pagination.KeysetCursorPagination',
+    'PAGE_SIZE': 50,
+    # Token bucket для входа и регистрации: емкость корзины и время ее
+    # полного пополнения (см. med/throttling.py)
+    'DEFAULT_THROTTLE_RATES': {
+        'auth_ip': '30/min',
+        'auth_email': '10/min',
+    },
 }
 
+# Максимальный размер страницы, который может запросить клиент
+PAGINATION_MAX_PAGE_SIZE = 500
+
+# Файл с общими для всех процессов хоста счетчиками ограничителя запросов и
+# количество корзин в нем
+THROTTLE_STORE_PATH = os.path.join(tempfile.gettempdir(), 'medapp-throttle.bin')
+THROTTLE_STORE_SLOTS = 65536
+
 ROOT_URLCONF = 'medAppApi.urls'
 
 TEMPLATES = [
@@ -157,6 +177,59 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'med.UserProfile'
 
+# Время жизни токена доступа и refresh токена
+JWT_ACCESS_TOKEN_LIFETIME = timedelta(minutes=30)
+JWT_REFRESH_TOKEN_LIFETIME = timedelta(days=30)
+
+# Число потоков waitress (см. server.py)
+SERVER_THREADS = 8
+
+# Пул хеширования паролей при входе и регистрации: число потоков, сколько
+# задач всего может находиться в пуле и сколько секунд запрос ждет
+# результат. Запрос ждет хеширования в потоке сервера, поэтому
+# PASSWORD_HASHING_MAX_PENDING должен быть меньше SERVER_THREADS. Разница
+# с PASSWORD_HASHING_WORKERS - сколько задач может ждать в очереди, прежде
+# чем пул начнет отвечать 503.
+PASSWORD_HASHING_WORKERS = 2
+PASSWORD_HASHING_MAX_PENDING = 4
+PASSWORD_HASHING_TIMEOUT = 5
+
+# Кэш пользователей для JWT аутентификации: время жизни записи в секундах и
+# максимальное количество записей в одном процессе
+JWT_USER_CACHE_TTL = 60
+JWT_USER_CACHE_MAX_SIZE = 10000
+
+# Длительность одного слота записи и максимальный период, за который можно
+# запросить свободные слоты
+APPOINTMENT_SLOT_DURATION = timedelta(minutes=30)
+AVAILABILITY_MAX_WINDOW = timedelta(days=31)
+# Максимальный период календаря записей
+CALENDAR_MAX_WINDOW = timedelta(days=92)
+
+# Кэш ответов справочников. LocMemCache работает в пределах одного процесса;
+# если воркеров несколько, используйте общий для них файловый кэш:
+#     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#     'LOCATION': os.path.join(tempfile.gettempdir(), 'medapp-catalog-cache'),
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+CATALOG_CACHE_ALIAS = 'catalog'
+# Сколько секунд версия модели может храниться в кэше без проверки по базе
+CATALOG_VERSION_TTL = 60
+
+# Добавлять в токен роль, флаг активности и версию токена. Аутентификация и
+# проверка ролей в этом случае не загружают пользователя из базы.
+JWT_SIGNED_CLAIMS = True
+
 CORS_ORIGIN_WHITELIST = [
     'http://127.0.0.1:8000',
     'https://saturn-mis.online/',
@@ -0,0 +1,83 @@
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.permissions import SAFE_METHODS
+
+FIELDS_QUERY_PARAM = 'fields'
+EXCLUDE_QUERY_PARAM = 'exclude'
+
+
+def get_requested_fields(request):
+    """
+    Разбирает параметры ?fields=a,b,c и ?exclude=d,e. Возвращает пару
+    (поля, которые нужно оставить, или None; поля, которые нужно убрать).
+    """
+    if request is None or request.method not in SAFE_METHODS:
+        return None, set()
+
+    fields = request.query_params.get(FIELDS_QUERY_PARAM)
+    exclude = request.query_params.get(EXCLUDE_QUERY_PARAM)
+
+    fields = {name.strip() for name in fields.split(',') if name.strip()} if fields else None
+    exclude = {name.strip() for name in exclude.split(',') if name.strip()} if exclude else set()
+    return fields, exclude
+
+
+class SparseFieldsetMixin:
+    """
+    Миксин сериализатора: при чтении убирает из ответа поля, не перечисленные
+    в ?fields= или перечисленные в ?exclude=. Запрос берется из контекста,
+    поэтому сериализатор нужно создавать через get_serializer().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        fields, exclude = get_requested_fields(self.context.get('request'))
+        if fields is None and not exclude:
+            return
+
+        for name in list(self.fields):
+            if (fields is not None and name not in fields) or name in exclude:
+                self.fields.pop(name)
+
+
+class SparseFieldsetFilter(BaseFilterBackend):
+    """
+    Сужает список столбцов запроса под поля, оставшиеся в сериализаторе после
+    ?fields= / ?exclude=. Если все поля ответа - столбцы модели, используется
+    only(), иначе (поле берется из свойства или метода) ненужные столбцы
+    откладываются через defer(). Поля сортировки модели загружаются всегда,
+    они нужны для курсора постраничной выдачи.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        fields, exclude = get_requested_fields(request)
+        if fields is None and not exclude:
+            return queryset
+
+        serializer_class = view.get_serializer_class()
+        meta = getattr(serializer_class, 'Meta', None)
+        if getattr(meta, 'model', None) is not queryset.model:
+            return queryset
+
+        opts = queryset.model._meta
+        columns = {field.name for field in opts.concrete_fields}
+        relations = {field.name for field in opts.many_to_many}
+        ordering = {name.lstrip('-') for name in opts.ordering} & columns
+
+        all_fields = serializer_class().fields
+        kept = set(view.get_serializer().fields)
+        kept_columns, narrowable = set(), True
+        for name, field in all_fields.items():
+            if name not in kept or field.write_only:
+                continue
+            if field.source in columns:
+                kept_columns.add(field.source)
+            elif field.source not in relations:
+                narrowable = False
+
+        if narrowable:
+            return queryset.only(*(kept_columns | ordering))
+
+        dropped = {field.source for name, field in all_fields.items()
+                   if name not in kept and field.source in columns}
+        return queryset.defer(*(dropped - kept_columns - ordering - {opts.pk.name}))
@@ -0,0 +1,45 @@
+from django.http import StreamingHttpResponse
+
+from med.renderers import dumps
+
+
+class StreamingListMixin:
+    """
+    Потоковая выдача списка для ListModelMixin. С параметром ?stream=1
+    записи читаются из базы серверным курсором порциями по
+    stream_chunk_size, сериализуются по одной и отправляются клиенту как
+    JSON массив частями. Память процесса не растет вместе с размером таблицы.
+    Без параметра представление работает как обычно.
+    """
+
+    stream_query_param = 'stream'
+    stream_chunk_size = 500
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.stream_query_param) not in ('1', 'true'):
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(self.stream_rows(queryset), content_type='application/json')
+
+    def stream_rows(self, queryset):
+        serializer = self.get_serializer()
+        buffer = [b'[']
+        delimiter = b''
+
+        for count, instance in enumerate(queryset.iterator(chunk_size=self.stream_chunk_size), 1):
+            buffer.append(delimiter)
+            buffer.append(self.encode_row(serializer.to_representation(instance)))
+            delimiter = b','
+
+            # Отправляем клиенту по одной порции на каждую прочитанную из
+            # курсора пачку записей
+            if count % self.stream_chunk_size == 0:
+                yield b''.join(buffer)
+                buffer = []
+
+        buffer.append(b']')
+        yield b''.join(buffer)
+
+    def encode_row(self, data):
+        return dumps(data)
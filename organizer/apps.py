@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class OrganizerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'organizer'
+
+    def ready(self):
+        # Регистрация обработчиков сигналов
+        from . import signal  # noqa: F401
@@ -1,6 +1,6 @@
 from django_filters import rest_framework as filters
 from organizer.models import *
-from med.models import SERVICE_CHOICES, Procedure, Event, Survey, Speciality, Service
+from med.models import SERVICE_CHOICES
 
 class RecordFilter(filters.FilterSet):
     date_start__gte = filters.IsoDateTimeFilter(field_name='date_start', lookup_expr='gte')
@@ -8,21 +8,7 @@ class RecordFilter(filters.FilterSet):
     service_type = filters.ChoiceFilter(field_name='service_type', choices=SERVICE_CHOICES, method='filter_service_type')
 
     def filter_service_type(self, queryset, name, value):
-        service_queryset = queryset.none()
-
-        if value == 'Procedure':
-            service_queryset = Procedure.objects.all()
-        elif value == 'Event':
-            service_queryset = Event.objects.all()
-        elif value == 'Survey':
-            service_queryset = Survey.objects.all()
-        elif value == 'Speciality':
-            service_queryset = Speciality.objects.all()
-
-        service_id_list = service_queryset.values_list('service__id', flat=True)
-        record_services = RecordService.objects.filter(service__id__in=service_id_list)
-        record_id_list = record_services.values_list('record__id', flat=True)
-        return queryset.filter(id__in=record_id_list)
+        return queryset.filter(record_service__service__service_type=value)
 
     class Meta:
         model = Record
@@ -37,19 +23,7 @@ class RecordServiceFilter(filters.FilterSet):
     service_type = filters.ChoiceFilter(field_name='service_type', choices=SERVICE_CHOICES, method='filter_service_type')
 
     def filter_service_type(self, queryset, name, value):
-        service_queryset = queryset.none()
-
-        if value == 'Procedure':
-            service_queryset = Procedure.objects.all()
-        elif value == 'Event':
-            service_queryset = Event.objects.all()
-        elif value == 'Survey':
-            service_queryset = Survey.objects.all()
-        elif value == 'Speciality':
-            service_queryset = Speciality.objects.all()
-
-        service_id_list = service_queryset.values_list('service__id', flat=True)
-        return queryset.filter(service__id__in=service_id_list)
+        return queryset.filter(service__service_type=value)
 
     class Meta:
         model = RecordService
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from organizer.models import RecordServiceMedPersona
+
+
+class Command(BaseCommand):
+    help = 'Заполняет RecordServiceMedPersona.period по времени записей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество строк в одной транзакции')
+
+    def handle(self, *args, **options):
+        queryset = RecordServiceMedPersona.objects.filter(period__isnull=True).select_related('record_service__record')
+
+        # Из записей с началом не раньше окончания интервал не построить,
+        # их нужно исправить вручную; period у них остается пустым
+        inverted = queryset.filter(record_service__record__date_start__gte=F('record_service__record__date_end'))
+        skipped = list(inverted.values_list('record_service__record_id', flat=True))
+        queryset = queryset.exclude(pk__in=inverted.values('pk'))
+
+        updated = 0
+        while True:
+            with transaction.atomic():
+                rows = list(queryset.order_by('pk')[:options['batch_size']])
+                if not rows:
+                    break
+
+                for row in rows:
+                    row.period = row.record_service.record.period
+                try:
+                    RecordServiceMedPersona.objects.bulk_update(rows, ['period'])
+                except IntegrityError as e:
+                    # Уже существующие пересечения нужно разобрать вручную
+                    raise CommandError('Найдены пересекающиеся записи медперсоны: %s' % e)
+            updated += len(rows)
+
+        self.stdout.write('Обновлено записей: %d' % updated)
+        if skipped:
+            self.stderr.write('Пропущены записи с некорректным временем: %s' % ', '.join(map(str, sorted(skipped))))
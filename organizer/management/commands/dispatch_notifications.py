@@ -0,0 +1,138 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from med.models import Notification, NotificationSettings, NotificationCounter, NOTIFICATION_UNREAD_STATUS
+from med.signal import publish_notifications
+from organizer.models import Record
+from organizer.timerwheel import TimerWheel
+
+
+class Command(BaseCommand):
+    help = 'Создает уведомления о предстоящих записях по времени из NotificationSettings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon', type=int, default=120, help='На сколько минут вперед загружаются записи')
+        parser.add_argument('--refill', type=int, default=60, help='Период перечитывания записей в секундах')
+        parser.add_argument('--tick', type=float, default=1.0, help='Шаг колеса таймеров в секундах')
+        parser.add_argument('--batch-size', type=int, default=500, help='Количество уведомлений в одном INSERT')
+        parser.add_argument('--once', action='store_true', help='Выполнить один проход и завершиться')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        self.batch_size = options['batch_size']
+        self.horizon = timedelta(minutes=options['horizon'])
+        self.wheel = TimerWheel(now.timestamp(), tick=options['tick'])
+        if self.horizon.total_seconds() > self.wheel.horizon:
+            raise CommandError('Горизонт больше диапазона колеса таймеров')
+
+        # Поставленные таймеры: ключ уведомления -> начало записи. В памяти
+        # держатся только записи горизонта, прошедшие удаляются при refill.
+        self.scheduled = {}
+        refill = timedelta(seconds=options['refill'])
+        next_refill = now
+
+        while True:
+            now = timezone.now()
+            if now >= next_refill:
+                self.refill(now)
+                next_refill = now + refill
+            self.dispatch(self.wheel.advance(now.timestamp()))
+            if options['once']:
+                break
+            time.sleep(options['tick'])
+
+    def refill(self, now):
+        """
+        Ставит таймеры для записей, начинающихся в пределах горизонта.
+        Записи выбираются диапазоном по date_start (индекс
+        record_date_range_idx), поэтому после перезапуска не нужен полный
+        просмотр таблицы, а уже созданные уведомления не дублируются
+        благодаря Notification.dedup_key.
+        """
+        self.scheduled = {key: date_start for key, date_start in self.scheduled.items() if date_start > now}
+
+        rows = Record.objects.filter(
+            date_start__gte=now,
+            date_start__lt=now + self.horizon,
+            done=False,
+        ).values_list(
+            'pk', 'name', 'date_start', 'patient__user_id',
+            'record_service__record_service_medpersona__medpersona__user_id',
+        )
+
+        records = {}
+        for pk, name, date_start, patient_user, medic_user in rows:
+            record = records.setdefault(pk, (name, date_start, set()))
+            record[2].add(patient_user)
+            if medic_user is not None:
+                record[2].add(medic_user)
+
+        users = {user for _, _, record_users in records.values() for user in record_users}
+        leads = {}
+        for user, lead in NotificationSettings.objects.filter(user_id__in=users).values_list('user_id', 'time'):
+            leads.setdefault(user, set()).add(lead)
+
+        for pk, (name, date_start, record_users) in records.items():
+            for user in record_users:
+                user_leads = leads.get(user, ())
+                # Из уже прошедших сроков (например, после простоя)
+                # отправляется только ближайший к началу записи
+                passed = sorted(lead for lead in user_leads if date_start - timedelta(minutes=lead) <= now)
+                for lead in user_leads:
+                    if lead in passed[1:]:
+                        continue
+                    # Начало записи входит в ключ: после переноса записи
+                    # напоминание о новом времени отправляется заново
+                    key = 'record:%d:%d:%d:%d' % (pk, date_start.timestamp(), user, lead)
+                    if self.scheduled.get(key) == date_start:
+                        continue
+                    # Если запись перенесли, старый таймер останется в колесе
+                    # и будет отброшен при срабатывании
+                    self.scheduled[key] = date_start
+                    fire_at = date_start - timedelta(minutes=lead)
+                    self.wheel.add(fire_at.timestamp(), (key, pk, name, date_start, user, lead))
+
+    def dispatch(self, expired):
+        expired = [item for item in expired if self.scheduled.get(item[0]) == item[3]]
+        if not expired:
+            return
+
+        # Запись могли перенести, завершить или удалить после refill
+        current = dict(Record.objects.filter(
+            pk__in={item[1] for item in expired},
+            done=False,
+        ).values_list('pk', 'date_start'))
+
+        keys = [item[0] for item in expired]
+        existing = set(Notification.objects.filter(dedup_key__in=keys).values_list('dedup_key', flat=True))
+
+        notifications = [
+            Notification(
+                user_id=user,
+                name='Запись',
+                description='Через %d мин. начнется запись «%s»' % (lead, name),
+                source='organizer',
+                status=NOTIFICATION_UNREAD_STATUS,
+                dedup_key=key,
+            )
+            for key, pk, name, date_start, user, lead in expired
+            if current.get(pk) == date_start and key not in existing
+        ]
+        if not notifications:
+            return
+
+        with transaction.atomic():
+            # Счетчики и события только для строк, вставленных этим вызовом:
+            # параллельный обработчик мог поставить часть уведомлений сам
+            created = Notification.objects.insert_new(notifications, batch_size=self.batch_size)
+
+            deltas = {}
+            for notification in created:
+                deltas[notification.user_id] = deltas.get(notification.user_id, 0) + 1
+            NotificationCounter.objects.add(deltas)
+            publish_notifications(created)
+        self.stdout.write('Поставлено уведомлений: %d' % len(created))
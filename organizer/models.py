@@ -1,10 +1,15 @@
-from django.db import models
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import BigIntegerRangeField, DateTimeRangeField, RangeOperators
+from django.db import models, transaction
+from psycopg2.extras import DateTimeTZRange
+
 from med.models import Patient, Service, MedPersona
 
 
 class Record(models.Model):
     name = models.CharField(verbose_name='Название', max_length=100)
-    patient = models.ForeignKey(Patient, verbose_name='Пациент', on_delete=models.CASCADE)
+    # Отдельный индекс не нужен: patient - первый столбец record_patient_idx
+    patient = models.ForeignKey(Patient, verbose_name='Пациент', on_delete=models.CASCADE, db_index=False)
     # service = models.ForeignKey(Service, verbose_name='Услуга', on_delete=models.CASCADE)
     date_of_creation = models.DateTimeField(verbose_name='Дата записи', auto_now_add=True, blank=True)
     date_start = models.DateTimeField(verbose_name='Дата начала')
@@ -17,10 +22,45 @@ class Record(models.Model):
         verbose_name = 'Запись'
         verbose_name_plural = 'Записи'
         ordering = ['done', '-date_start']
+        indexes = [
+            # Ключ постраничной выдачи: сортировка записей и id
+            models.Index(fields=['done', '-date_start', '-id'], name='record_keyset_idx'),
+            # Записи пациента (RecordList для пациента) в порядке сортировки
+            models.Index(fields=['patient', 'done', '-date_start', '-id'], name='record_patient_idx'),
+            # Фильтр RecordFilter по date_start__gte / date_end__lte
+            models.Index(fields=['date_start', 'date_end'], name='record_date_range_idx'),
+        ]
+
+    # Поля, изменение которых отправляется участникам записи событием
+    PUSHED_FIELDS = ('done', 'editable', 'date_start', 'date_end')
 
     def __str__(self):
         return 'Запись ' + str(self.id)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.pushed_values = instance.get_pushed_values()
+        return instance
+
+    def get_pushed_values(self):
+        # Отложенные поля не загружаются: их значения неизвестны
+        return {name: self.__dict__.get(name, models.DEFERRED) for name in self.PUSHED_FIELDS}
+
+    def save(self, *args, **kwargs):
+        # Интервал записи продублирован в RecordServiceMedPersona.period, где
+        # на него наложено ограничение от пересечений. Если новое время
+        # пересекается с другой записью медперсоны, откатывается и сама запись.
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if not adding:
+                RecordServiceMedPersona.objects.filter(record_service__record=self).update(period=self.period)
+
+    @property
+    def period(self):
+        return DateTimeTZRange(self.date_start, self.date_end, '[)')
+
 
 class RecordService(models.Model):
     record = models.OneToOneField(
@@ -44,6 +84,16 @@ class RecordService(models.Model):
         return 'Запись-Услуга ' + str(self.id)
 
 
+def medpersona_range():
+    """
+    Вырожденный диапазон [medpersona, medpersona] - первое выражение индекса
+    ограничения record_medpersona_no_overlap. Запросы с тем же выражением
+    могут пользоваться этим индексом.
+    """
+    return models.Func(models.F('medpersona'), models.F('medpersona'), models.Value('[]'), function='int8range',
+                       output_field=BigIntegerRangeField())
+
+
 class RecordServiceMedPersona(models.Model):
     record_service = models.OneToOneField(
         RecordService,
@@ -60,10 +110,32 @@ class RecordServiceMedPersona(models.Model):
         related_name='medpersona_record_service',
         on_delete=models.CASCADE,
     )
+    # Копия интервала записи [date_start, date_end), поддерживается
+    # Record.save и save этой модели
+    period = DateTimeRangeField(verbose_name='Время приема', null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = 'Запись-Услуга-Медперсона'
         verbose_name_plural = 'Записи-Услуги-Медперсоны'
+        constraints = [
+            # Записи одной медперсоны не могут пересекаться по времени.
+            # Равенство медперсоны выражено пересечением вырожденных
+            # диапазонов [id, id], поэтому расширение btree_gist не нужно.
+            ExclusionConstraint(
+                name='record_medpersona_no_overlap',
+                expressions=[
+                    (medpersona_range(), RangeOperators.OVERLAPS),
+                    ('period', RangeOperators.OVERLAPS),
+                ],
+            ),
+        ]
 
     def __str__(self):
-        return 'Запись-Услуга-Медперсона ' + str(self.id)
\ No newline at end of file
+        return 'Запись-Услуга-Медперсона ' + str(self.id)
+
+    def save(self, *args, **kwargs):
+        record = Record.objects.filter(record_service=self.record_service_id).only('date_start', 'date_end').first()
+        if record is not None:
+            self.period = record.period
+        with transaction.atomic():
+            super().save(*args, **kwargs)
\ No newline at end of file
@@ -1,32 +1,191 @@
+from datetime import timedelta
+
+from django.db import transaction
 from rest_framework import serializers
 from organizer.models import *
-from med.models import Notes, Task
+from med.models import Notes, Task, Service, MedPersona, ServiceMedPersona, TASK_STATUS_CHOICES
+from med.serializers import PeriodQuerySerializer
+from medAppApi.sparse_fields import SparseFieldsetMixin
 
-class RecordSerializer(serializers.ModelSerializer):
+class RecordSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Record
         fields = '__all__'
 
+    def validate(self, data):
+        # При частичном изменении недостающая граница берется из записи
+        date_start = data.get('date_start', getattr(self.instance, 'date_start', None))
+        date_end = data.get('date_end', getattr(self.instance, 'date_end', None))
+        if date_start is not None and date_end is not None and date_start >= date_end:
+            raise serializers.ValidationError('Дата начала должна быть раньше даты окончания.')
+        return data
+
 
-class RecordServiceSerializer(serializers.ModelSerializer):
+class RecordServiceSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = RecordService
         fields = '__all__';
 
 
-class RecordMedPersonaSerializer(serializers.ModelSerializer):
+class RecordMedPersonaSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = RecordServiceMedPersona
-        fields = '__all__'
+        # Интервал дублирует время записи и нужен только для ограничения
+        exclude = ('period',)
 
+    def validate(self, data):
+        # Интервал строится по времени записи, которое в старых записях
+        # может быть некорректным
+        record = data['record_service'].record
+        if record.date_start >= record.date_end:
+            raise serializers.ValidationError('Дата начала записи должна быть раньше даты окончания.')
+        return data
 
-class NoteSerializer(serializers.ModelSerializer):
+
+class NoteSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Notes
         fields = '__all__'
 
 
-class TaskSerializer(serializers.ModelSerializer):
+class TaskSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Task
         fields = '__all__'
+
+
+class NoteWithTasksSerializer(NoteSerializer):
+    # Задачи берутся из prefetch_related('task_set'), см. NoteList
+    tasks = TaskSerializer(source='task_set', many=True, read_only=True)
+
+
+class TaskBulkUpdateListSerializer(serializers.ListSerializer):
+    def validate(self, data):
+        ids = [item['id'] for item in data]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError('Идентификаторы задач повторяются.')
+        return data
+
+
+class TaskBulkUpdateSerializer(serializers.Serializer):
+    """ Изменение одной задачи в пакетном PATCH заметки. """
+    id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=TASK_STATUS_CHOICES, required=False)
+    description = serializers.CharField(required=False)
+
+    class Meta:
+        list_serializer_class = TaskBulkUpdateListSerializer
+
+    def validate(self, data):
+        if len(data) == 1:
+            raise serializers.ValidationError('Не переданы изменяемые поля.')
+        return data
+
+
+class TaskBulkDeleteSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+
+def create_bookings(items, patient):
+    """
+    Создает записи на прием вместе с услугами и медперсонами: по одному
+    INSERT на каждую из трех таблиц в одной транзакции, сколько бы записей
+    ни было в запросе.
+    """
+    with transaction.atomic():
+        records = Record.objects.bulk_create([
+            Record(
+                name=item['name'],
+                patient=patient,
+                date_start=item['date_start'],
+                date_end=item['date_end'],
+                description=item.get('description', ''),
+            )
+            for item in items
+        ])
+        record_services = RecordService.objects.bulk_create([
+            RecordService(record=record, service=item['service'])
+            for record, item in zip(records, items)
+        ])
+        record_service_medpersonas = RecordServiceMedPersona.objects.bulk_create([
+            RecordServiceMedPersona(record_service=record_service, medpersona=item['medpersona'], period=record.period)
+            for record, record_service, item in zip(records, record_services, items)
+        ])
+
+    return [
+        {'record': record, 'record_service': record_service, 'record_service_medpersona': medpersona}
+        for record, record_service, medpersona in zip(records, record_services, record_service_medpersonas)
+    ]
+
+
+class BookingListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        return create_bookings(validated_data, self.context['patient'])
+
+
+class BookingSerializer(serializers.Serializer):
+    """
+    Запись на прием одним запросом: Record, RecordService и
+    RecordServiceMedPersona создаются вместе или не создаются вовсе.
+    Пациент передается в контексте.
+    """
+    name = serializers.CharField(max_length=100, write_only=True)
+    date_start = serializers.DateTimeField(write_only=True)
+    date_end = serializers.DateTimeField(write_only=True)
+    description = serializers.CharField(max_length=500, required=False, allow_blank=True, write_only=True)
+    service = serializers.PrimaryKeyRelatedField(queryset=Service.objects.all(), write_only=True)
+    medpersona = serializers.PrimaryKeyRelatedField(queryset=MedPersona.objects.all(), write_only=True)
+
+    record = RecordSerializer(read_only=True)
+    record_service = RecordServiceSerializer(read_only=True)
+    record_service_medpersona = RecordMedPersonaSerializer(read_only=True)
+
+    class Meta:
+        list_serializer_class = BookingListSerializer
+
+    def validate(self, data):
+        if data['date_start'] >= data['date_end']:
+            raise serializers.ValidationError('Дата начала должна быть раньше даты окончания.')
+
+        if not ServiceMedPersona.objects.filter(service=data['service'], medpersona=data['medpersona']).exists():
+            raise serializers.ValidationError('Медперсона не оказывает эту услугу.')
+        return data
+
+    def create(self, validated_data):
+        return create_bookings([validated_data], self.context['patient'])[0]
+
+
+class CalendarQuerySerializer(PeriodQuerySerializer):
+    max_window_setting = 'CALENDAR_MAX_WINDOW'
+    default_max_window = timedelta(days=92)
+
+
+class CalendarServiceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Service
+        fields = ('id', 'name', 'service_type')
+
+
+class CalendarMedPersonaSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source='user.name')
+    surname = serializers.CharField(source='user.surname')
+    patronymic = serializers.CharField(source='user.patronymic')
+
+    class Meta:
+        model = MedPersona
+        fields = ('id', 'name', 'surname', 'patronymic', 'position', 'location')
+
+
+class CalendarRecordSerializer(serializers.ModelSerializer):
+    """
+    Запись календаря вместе с услугой и медперсоной. Queryset должен
+    загружать их через select_related, иначе на каждую запись будут
+    дополнительные запросы.
+    """
+    service = CalendarServiceSerializer(source='record_service.service', read_only=True)
+    medpersona = CalendarMedPersonaSerializer(source='record_service.record_service_medpersona.medpersona',
+                                              read_only=True)
+
+    class Meta:
+        model = Record
+        fields = ('id', 'name', 'date_start', 'date_end', 'done', 'description', 'service', 'medpersona')
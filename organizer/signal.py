@@ -0,0 +1,52 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from medAppApi.events import publish
+from .models import Record, RecordService, RecordServiceMedPersona
+
+
+def get_recipients(record):
+    """
+    Пользователи пациента и медперсоны записи. Если связи уже загружены
+    (select_related в RecordDetail), дополнительный запрос не выполняется.
+    """
+    if Record.patient.is_cached(record):
+        recipients = {record.patient.user_id}
+        related = record
+        for relation in (Record.record_service.related, RecordService.record_service_medpersona.related,
+                         RecordServiceMedPersona.medpersona.field):
+            if not relation.is_cached(related):
+                break
+            related = relation.get_cached_value(related)
+            if related is None:
+                return recipients
+        else:
+            recipients.add(related.user_id)
+            return recipients
+
+    recipients = set()
+    for patient_user, medic_user in Record.objects.filter(pk=record.pk).values_list(
+            'patient__user_id', 'record_service__record_service_medpersona__medpersona__user_id'):
+        recipients.update({patient_user, medic_user} - {None})
+    return recipients
+
+
+@receiver(post_save, sender=Record)
+def push_record(sender, instance, created, update_fields=None, **kwargs):
+    # О новых записях пользователи знают из ответа на создание, событие
+    # нужно только при изменении отправляемых полей: завершении, переносе и т.д.
+    if update_fields is not None and not update_fields & set(Record.PUSHED_FIELDS):
+        return
+    values = instance.get_pushed_values()
+    previous, instance.pushed_values = getattr(instance, 'pushed_values', None), values
+    if created or values == previous:
+        return
+
+    publish(get_recipients(instance), {
+        'type': 'record',
+        'id': instance.pk,
+        'done': instance.done,
+        'editable': instance.editable,
+        'date_start': instance.date_start,
+        'date_end': instance.date_end,
+    })
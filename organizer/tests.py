@@ -1,3 +1,508 @@
-from django.test import TestCase
+import datetime
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.test import APITestCase, APIRequestFactory
+
+from med.models import UserProfile, Patient, MedPersona, Service, ServiceMedPersona, Notification, \
+    NotificationSettings, NotificationCounter, Notes, Task
+from organizer.models import Record, RecordService, RecordServiceMedPersona
+from organizer.signal import get_recipients
+from medAppApi.pagination import KeysetCursorPagination
+from organizer.timerwheel import TimerWheel
+
+
+class OrganizerTestCase(APITestCase):
+    # Пациент, медперсона и услуга, которую она оказывает
+    @classmethod
+    def setUpTestData(cls):
+        patient_user = UserProfile.objects.create_user(
+            email='user1@mail.com',
+            name='name1',
+            surname='surname1',
+            patronymic='patronymic1',
+            phone_number='+79998887766',
+            role='Patient',
+            password='user1password',
+        )
+        cls.patient = Patient.objects.create(user=patient_user, gender='Male', region='region', city='city',
+                                             type='Treating', group=[])
+        medic_user = UserProfile.objects.create_user(
+            email='user2@mail.com',
+            name='name2',
+            surname='surname2',
+            patronymic='patronymic2',
+            phone_number='+79998887755',
+            role='Doctor',
+            password='user2password',
+        )
+        cls.medpersona = MedPersona.objects.create(user=medic_user, birth_date='2001-08-03', position='Doctor',
+                                                   qualification='3', experience='5 years')
+        cls.service = Service.objects.create(name='service', cost=100)
+        cls.other_service = Service.objects.create(name='other', cost=100)
+        ServiceMedPersona.objects.create(service=cls.service, medpersona=cls.medpersona, type='Procedure')
+
+
+class BookingCreateTests(OrganizerTestCase):
+    def setUp(self):
+        self.url = reverse('booking-create')
+        self.client.force_authenticate(user=self.patient.user)
+        self.data = {
+            'name': 'booking',
+            'date_start': '2021-05-03T10:00:00Z',
+            'date_end': '2021-05-03T10:30:00Z',
+            'service': self.service.pk,
+            'medpersona': self.medpersona.pk,
+        }
+
+    def test_create(self):
+        response = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        record = Record.objects.get(pk=response.data['record']['id'])
+        self.assertEqual(record.patient, self.patient)
+        self.assertEqual(response.data['record_service']['service'], self.service.pk)
+        self.assertEqual(response.data['record_service_medpersona']['medpersona'], self.medpersona.pk)
+        self.assertEqual(RecordServiceMedPersona.objects.get().record_service.record, record)
+
+    def test_create_many(self):
+        second = dict(self.data, date_start='2021-05-03T11:00:00Z', date_end='2021-05-03T11:30:00Z')
+        response = self.client.post(self.url, [self.data, second], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(RecordServiceMedPersona.objects.count(), 2)
+
+    def test_invalid(self):
+        # Медперсона не оказывает услугу: не создается ни одна из трех записей
+        invalid = dict(self.data, service=self.other_service.pk)
+        response = self.client.post(self.url, [self.data, invalid], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Record.objects.count(), 0)
+        self.assertEqual(RecordService.objects.count(), 0)
+
+    def test_overlap(self):
+        response = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        overlapping = dict(self.data, date_start='2021-05-03T10:15:00Z', date_end='2021-05-03T10:45:00Z')
+        response = self.client.post(self.url, overlapping, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Record.objects.count(), 1)
+
+        # Запись сразу после предыдущей не пересекается с ней
+        adjacent = dict(self.data, date_start='2021-05-03T10:30:00Z', date_end='2021-05-03T11:00:00Z')
+        response = self.client.post(self.url, adjacent, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # Перенос второй записи на время первой
+        self.client.force_authenticate(user=self.medpersona.user)
+        url = reverse('record-detail', kwargs={'pk': response.data['record']['id']})
+        response = self.client.patch(url, {'date_start': '2021-05-03T10:00:00Z'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(RecordServiceMedPersona.objects.filter(period__overlap=(
+            datetime.datetime(2021, 5, 3, 10, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2021, 5, 3, 10, 30, tzinfo=datetime.timezone.utc),
+        )).count(), 1)
+
+    def test_medic_forbidden(self):
+        self.client.force_authenticate(user=self.medpersona.user)
+        response = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class RecordDatesTests(OrganizerTestCase):
+    # Интервал записи строится по date_start и date_end, поэтому
+    # некорректное время отклоняется до обращения к Postgres
+    def setUp(self):
+        date_start = datetime.datetime(2021, 5, 3, 10, tzinfo=datetime.timezone.utc)
+        self.record = Record.objects.create(name='record', patient=self.patient, date_start=date_start,
+                                            date_end=date_start + datetime.timedelta(minutes=30))
+        self.record_service = RecordService.objects.create(record=self.record, service=self.service)
+
+    def test_inverted_update(self):
+        self.client.force_authenticate(user=self.medpersona.user)
+        url = reverse('record-detail', kwargs={'pk': self.record.pk})
+        response = self.client.patch(url, {'date_end': '2021-05-03T09:00:00Z'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(url, {'date_start': '2021-05-03T10:30:00Z'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_inverted_record_medpersona(self):
+        Record.objects.filter(pk=self.record.pk).update(date_end=self.record.date_start)
+        self.client.force_authenticate(user=self.patient.user)
+        response = self.client.post(reverse('record-servier-medpersona-list'), {
+            'record_service': self.record_service.pk,
+            'medpersona': self.medpersona.pk,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(RecordServiceMedPersona.objects.exists())
+
+    def test_backfill_inverted(self):
+        RecordServiceMedPersona.objects.create(record_service=self.record_service, medpersona=self.medpersona)
+        Record.objects.filter(pk=self.record.pk).update(date_end=self.record.date_start)
+        RecordServiceMedPersona.objects.update(period=None)
+
+        stderr = StringIO()
+        call_command('backfill_record_periods', stdout=StringIO(), stderr=stderr)
+        self.assertIn(str(self.record.pk), stderr.getvalue())
+        self.assertIsNone(RecordServiceMedPersona.objects.get().period)
+
+
+class CalendarTests(OrganizerTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        start = datetime.datetime(2021, 5, 3, 10, tzinfo=datetime.timezone.utc)
+        # Понедельник, два приема во вторник и понедельник следующей недели
+        for days, hours in ((0, 0), (1, 0), (1, 2), (7, 0)):
+            date_start = start + datetime.timedelta(days=days, hours=hours)
+            record = Record.objects.create(name='record', patient=cls.patient, date_start=date_start,
+                                           date_end=date_start + datetime.timedelta(minutes=30))
+            record_service = RecordService.objects.create(record=record, service=cls.service)
+            RecordServiceMedPersona.objects.create(record_service=record_service, medpersona=cls.medpersona)
+        # Запись без услуги
+        Record.objects.create(name='empty', patient=cls.patient, date_start=start + datetime.timedelta(days=2),
+                              date_end=start + datetime.timedelta(days=2, minutes=30))
+
+    def setUp(self):
+        self.url = reverse('calendar')
+        self.params = {'from': '2021-05-01T00:00:00Z', 'to': '2021-05-31T00:00:00Z'}
+
+    def test_patient(self):
+        self.client.force_authenticate(user=self.patient.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, self.params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        weeks = response.json()
+        self.assertEqual([week['week'] for week in weeks], ['2021-05-03', '2021-05-10'])
+        self.assertEqual([day['date'] for day in weeks[0]['days']], ['2021-05-03', '2021-05-04', '2021-05-05'])
+        self.assertEqual(len(weeks[0]['days'][1]['records']), 2)
+
+        record = weeks[0]['days'][0]['records'][0]
+        self.assertEqual(record['service']['name'], 'service')
+        self.assertEqual(record['medpersona']['surname'], 'surname2')
+        self.assertIsNone(weeks[0]['days'][2]['records'][0]['medpersona'])
+
+    def test_medic(self):
+        self.client.force_authenticate(user=self.medpersona.user)
+        response = self.client.get(self.url, self.params)
+        self.assertEqual(sum(len(day['records']) for week in response.data for day in week['days']), 4)
+
+    def test_invalid_window(self):
+        self.client.force_authenticate(user=self.patient.user)
+        response = self.client.get(self.url, {'from': '2021-05-01T00:00:00Z', 'to': '2022-05-01T00:00:00Z'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class NoteListTests(OrganizerTestCase):
+    def setUp(self):
+        self.url = reverse('note-list')
+        self.client.force_authenticate(user=self.patient.user)
+
+    def create_notes(self, count):
+        for i in range(count):
+            note = Notes.objects.create(user=self.patient.user, title='note%d' % i)
+            Task.objects.bulk_create([Task(note=note, description='task', status='Not done') for _ in range(3)])
+
+    def get_expanded(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'expand': 'tasks'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_expand_tasks(self):
+        self.create_notes(2)
+        response, queries = self.get_expanded()
+        results = response.data
+        self.assertEqual(len(results), 2)
+        self.assertEqual([len(note['tasks']) for note in results], [3, 3])
+        self.assertEqual(results[0]['tasks'][0]['note'], results[0]['id'])
+
+        # Количество запросов не зависит от количества заметок
+        self.create_notes(5)
+        response, more_queries = self.get_expanded()
+        self.assertEqual(len(response.data), 7)
+        self.assertEqual(queries, more_queries)
+
+    def test_without_expand(self):
+        self.create_notes(1)
+        response = self.client.get(self.url)
+        self.assertNotIn('tasks', response.data[0])
+
+
+class TaskBulkTests(OrganizerTestCase):
+    def setUp(self):
+        self.note = Notes.objects.create(user=self.patient.user, title='note')
+        self.tasks = Task.objects.bulk_create([
+            Task(note=self.note, description='task%d' % i, status='Not done') for i in range(3)
+        ])
+        # Задача чужой заметки
+        other = Notes.objects.create(user=self.medpersona.user, title='other')
+        self.other_task = Task.objects.create(note=other, description='other', status='Not done')
+
+        self.url = reverse('task-list', kwargs={'note_pk': self.note.pk})
+        self.client.force_authenticate(user=self.patient.user)
+
+    def test_patch(self):
+        data = [
+            {'id': self.tasks[0].pk, 'status': 'Done'},
+            {'id': self.tasks[1].pk, 'status': 'Done', 'description': 'changed'},
+            {'id': self.other_task.pk, 'status': 'Done'},
+        ]
+        response = self.client.patch(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['result'] for item in response.data], ['updated', 'updated', 'not_found'])
+        self.assertEqual(response.data[1]['task']['description'], 'changed')
+
+        self.assertEqual(list(Task.objects.filter(note=self.note).order_by('pk').values_list('status', 'description')),
+                         [('Done', 'task0'), ('Done', 'changed'), ('Not done', 'task2')])
+        self.assertEqual(Task.objects.get(pk=self.other_task.pk).status, 'Not done')
+
+    def test_patch_invalid(self):
+        for data in ([{'id': self.tasks[0].pk}],
+                     [{'id': self.tasks[0].pk, 'status': 'Unknown'}],
+                     [{'id': self.tasks[0].pk, 'status': 'Done'}, {'id': self.tasks[0].pk, 'status': 'Done'}]):
+            response = self.client.patch(self.url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Task.objects.filter(status='Done').exists())
+
+    def test_delete(self):
+        data = {'ids': [self.tasks[0].pk, self.tasks[1].pk, self.other_task.pk]}
+        response = self.client.delete(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['result'] for item in response.data], ['deleted', 'deleted', 'not_found'])
+        self.assertEqual(list(Task.objects.filter(note=self.note)), [self.tasks[2]])
+        self.assertTrue(Task.objects.filter(pk=self.other_task.pk).exists())
+
+    def test_foreign_note(self):
+        self.client.force_authenticate(user=self.medpersona.user)
+        response = self.client.delete(self.url, {'ids': [self.tasks[0].pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Task.objects.filter(note=self.note).count(), 3)
+
+
+class RecordIndexTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        start = datetime.datetime(2021, 5, 3, tzinfo=datetime.timezone.utc)
+        cls.users = []
+        records = []
+        for i in range(5):
+            user = UserProfile.objects.create_user(
+                email='user%d@mail.com' % i,
+                name='name%d' % i,
+                surname='surname%d' % i,
+                patronymic='patronymic%d' % i,
+                phone_number='+7999888770%d' % i,
+                role='Patient',
+                password='user%dpassword' % i,
+            )
+            patient = Patient.objects.create(user=user, gender='Male', region='region', city='city',
+                                             type='Treating', group=[])
+            cls.users.append(user)
+            records += [
+                Record(name='record', patient=patient, done=j % 3 == 0,
+                       date_start=start + datetime.timedelta(hours=j),
+                       date_end=start + datetime.timedelta(hours=j, minutes=30))
+                for j in range(200)
+            ]
+        Record.objects.bulk_create(records)
+
+    def assertIndexScan(self, queryset, index):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE organizer_record')
+            # На маленькой таблице планировщик и так выбрал бы полный
+            # просмотр, поэтому запрещаем его: если подходящего индекса нет,
+            # Seq Scan останется в плане.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan, plan)
+        self.assertIn(index, plan, plan)
+
+    def test_patient_records(self):
+        self.assertIndexScan(Record.objects.filter(patient__user=self.users[0]), 'record_patient_idx')
+
+    def test_all_records(self):
+        self.assertIndexScan(Record.objects.order_by('done', '-date_start', '-id')[:50], 'record_keyset_idx')
+
+    def test_keyset_pages(self):
+        # Страницы RecordList: каждый запрос читает диапазон record_keyset_idx
+        # с позиции курсора, поэтому глубокие страницы стоят как первые
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE organizer_record')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+        paginator = KeysetCursorPagination()
+        params = {'page_size': 70}
+        ids, queries = [], []
+        while True:
+            request = Request(APIRequestFactory().get('/', params))
+            with CaptureQueriesContext(connection) as captured:
+                page = paginator.paginate_queryset(Record.objects.all(), request)
+            ids += [record.pk for record in page]
+            queries += [query['sql'] for query in captured]
+            if not paginator.has_next:
+                break
+            params['cursor'] = paginator.encode_cursor(
+                [paginator._get_value(page[-1], field.lstrip('-')) for field in paginator.ordering])
+
+        self.assertEqual(ids, list(Record.objects.order_by('done', '-date_start', '-id').values_list('pk', flat=True)))
+        # Страница на границе done собирается из двух диапазонов
+        self.assertTrue(any('("organizer_record"."date_start", "organizer_record"."id") < (' in sql for sql in queries))
+        self.assertTrue(any('("organizer_record"."done") > (' in sql for sql in queries))
+        for sql in queries[1:]:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN ' + sql)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            self.assertIn('record_keyset_idx', plan, plan)
+            self.assertIn('Index Cond', plan, plan)
+            self.assertNotIn('Filter', plan, plan)
+
+    def test_date_range(self):
+        start = datetime.datetime(2021, 5, 5, tzinfo=datetime.timezone.utc)
+        self.assertIndexScan(Record.objects.filter(date_start__gte=start,
+                                                   date_end__lte=start + datetime.timedelta(days=1)),
+                             'record_date_range_idx')
+
+
+class RecordEventTests(OrganizerTestCase):
+    def setUp(self):
+        date_start = datetime.datetime(2021, 5, 3, 10, tzinfo=datetime.timezone.utc)
+        record = Record.objects.create(name='record', patient=self.patient, date_start=date_start,
+                                       date_end=date_start + datetime.timedelta(minutes=30))
+        record_service = RecordService.objects.create(record=record, service=self.service)
+        RecordServiceMedPersona.objects.create(record_service=record_service, medpersona=self.medpersona)
+        self.record = Record.objects.select_related(
+            'patient', 'record_service__record_service_medpersona__medpersona').get(pk=record.pk)
+
+    def test_recipients(self):
+        recipients = {self.patient.user_id, self.medpersona.user_id}
+        with self.assertNumQueries(0):
+            self.assertEqual(get_recipients(self.record), recipients)
+        self.assertEqual(get_recipients(Record.objects.get(pk=self.record.pk)), recipients)
+
+    def test_changed(self):
+        with mock.patch('organizer.signal.publish') as publish:
+            self.record.done = True
+            self.record.save()
+        publish.assert_called_once()
+        self.assertEqual(publish.call_args[0][0], {self.patient.user_id, self.medpersona.user_id})
+        self.assertTrue(publish.call_args[0][1]['done'])
+
+    def test_unchanged(self):
+        with mock.patch('organizer.signal.publish') as publish:
+            self.record.save()
+            self.record.description = 'description'
+            self.record.save(update_fields=['description'])
+            self.record.done = True
+            self.record.save()
+            # Повторное сохранение без изменений события не отправляет
+            self.record.save()
+        publish.assert_called_once()
+
+
+class TimerWheelTests(APITestCase):
+    def test_advance(self):
+        wheel = TimerWheel(1000)
+        for deadline in (999, 1001, 1059, 1060, 4600, 1000 + wheel.horizon):
+            wheel.add(deadline, deadline)
+
+        self.assertEqual(wheel.advance(1000), [999])
+        self.assertEqual(wheel.advance(1059), [1001, 1059])
+        self.assertEqual(wheel.advance(4599), [1060])
+        self.assertEqual(wheel.advance(4600), [4600])
+        self.assertEqual(wheel.advance(1000 + wheel.horizon), [1000 + wheel.horizon])
+        self.assertEqual(len(wheel), 0)
+
+    def test_out_of_range(self):
+        wheel = TimerWheel(0)
+        with self.assertRaises(ValueError):
+            wheel.add(wheel.horizon * 2, 'late')
+
+
+class DispatchNotificationsTests(OrganizerTestCase):
+    def setUp(self):
+        date_start = timezone.now() + datetime.timedelta(minutes=20)
+        self.record = Record.objects.create(name='record', patient=self.patient, date_start=date_start,
+                                            date_end=date_start + datetime.timedelta(minutes=30))
+        record_service = RecordService.objects.create(record=self.record, service=self.service)
+        RecordServiceMedPersona.objects.create(record_service=record_service, medpersona=self.medpersona)
+        for time in (10, 30, 60):
+            NotificationSettings.objects.create(user=self.patient.user, time=time)
+        NotificationSettings.objects.create(user=self.medpersona.user, time=60)
+
+    def dispatch(self):
+        call_command('dispatch_notifications', '--once', stdout=StringIO())
+
+    def key(self, user, lead):
+        return 'record:%d:%d:%d:%d' % (self.record.pk, self.record.date_start.timestamp(), user.pk, lead)
+
+    def test_dispatch(self):
+        self.dispatch()
+        # Из прошедших сроков 30 и 60 минут отправляется только ближайший,
+        # до срока 10 минут еще не дошло
+        self.assertEqual(
+            sorted(Notification.objects.values_list('user_id', 'dedup_key')),
+            sorted([
+                (self.patient.user_id, self.key(self.patient.user, 30)),
+                (self.medpersona.user_id, self.key(self.medpersona.user, 60)),
+            ]),
+        )
+
+        self.assertEqual(NotificationCounter.objects.get(user=self.patient.user).unread, 1)
+
+        # Повторный запуск после перезапуска не дублирует уведомления
+        self.dispatch()
+        self.assertEqual(Notification.objects.count(), 2)
+        self.assertEqual(NotificationCounter.objects.get(user=self.patient.user).unread, 1)
+
+    def test_rescheduled(self):
+        self.dispatch()
+        sent = set(Notification.objects.values_list('dedup_key', flat=True))
+
+        # После переноса на 50 минут вперед прошел только срок 60 минут,
+        # напоминания о новом времени отправляются обоим участникам
+        self.record.date_start = timezone.now() + datetime.timedelta(minutes=50)
+        self.record.date_end = self.record.date_start + datetime.timedelta(minutes=30)
+        self.record.save()
+        self.dispatch()
+
+        self.assertEqual(
+            set(Notification.objects.values_list('dedup_key', flat=True)) - sent,
+            {self.key(self.patient.user, 60), self.key(self.medpersona.user, 60)},
+        )
+        self.assertEqual(NotificationCounter.objects.get(user=self.patient.user).unread, 2)
+
+    def test_concurrent(self):
+        # Другой обработчик ставит уведомление пациента между проверкой
+        # существующих ключей и вставкой: счетчик и событие остаются за ним
+        insert_new = Notification.objects.insert_new
+
+        def insert_after_other(notifications, **kwargs):
+            Notification.objects.create(user=self.patient.user, name='Запись', description='description',
+                                        source='organizer', status='Not Sended',
+                                        dedup_key=self.key(self.patient.user, 30))
+            return insert_new(notifications, **kwargs)
+
+        with mock.patch.object(Notification.objects, 'insert_new', side_effect=insert_after_other), \
+                mock.patch('organizer.management.commands.dispatch_notifications.publish_notifications') as publish:
+            self.dispatch()
+
+        self.assertEqual(Notification.objects.count(), 2)
+        self.assertEqual(NotificationCounter.objects.get(user=self.patient.user).unread, 1)
+        self.assertEqual(NotificationCounter.objects.get(user=self.medpersona.user).unread, 1)
+        self.assertEqual([notification.dedup_key for notification in publish.call_args[0][0]],
+                         [self.key(self.medpersona.user, 60)])
+
+    def test_done(self):
+        Record.objects.filter(pk=self.record.pk).update(done=True)
+        self.dispatch()
+        self.assertFalse(Notification.objects.exists())
@@ -0,0 +1,77 @@
+class TimerWheel:
+    """
+    Иерархическое колесо таймеров. Время делится на тики длиной tick
+    секунд; уровень 0 хранит таймеры ближайших levels[0] тиков по одному
+    слоту на тик, уровень 1 - следующие интервалы по levels[0] тиков и т.д.
+    Добавление таймера и срабатывание выполняются за O(1), а при переходе
+    через границу интервала таймеры старшего уровня переносятся на младшие.
+
+    По умолчанию (60, 60, 24) при тике в секунду покрывают не менее 23
+    часов вперед. Более дальние таймеры не принимаются.
+    """
+
+    def __init__(self, start, tick=1.0, levels=(60, 60, 24)):
+        self.tick = tick
+        self.levels = levels
+        self.spans = []
+        span = 1
+        for size in levels:
+            self.spans.append(span)
+            span *= size
+        self.wheels = [[[] for _ in range(size)] for size in levels]
+        # Насколько далеко вперед таймер гарантированно принимается
+        self.horizon = tick * self.spans[-1] * (levels[-1] - 1)
+        self.current = int(start // tick)
+        self._due = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, deadline, item):
+        """ Добавляет item, который сработает в момент deadline (timestamp). """
+        ticks = int(deadline // self.tick)
+        if ticks <= self.current:
+            # Срок уже наступил: отдадим при ближайшем advance
+            self._due.append(item)
+        else:
+            self._place(ticks, item)
+        self._count += 1
+
+    def advance(self, now):
+        """ Продвигает колесо до момента now и возвращает сработавшие таймеры. """
+        expired, self._due = self._due, []
+        target = int(now // self.tick)
+
+        while self.current < target:
+            self.current += 1
+
+            # Переносим таймеры со старших уровней, начиная с самого старшего,
+            # чтобы перенесенные на средний уровень тоже успели опуститься
+            for level in range(len(self.levels) - 1, 0, -1):
+                if self.current % self.spans[level] == 0:
+                    slot = (self.current // self.spans[level]) % self.levels[level]
+                    entries, self.wheels[level][slot] = self.wheels[level][slot], []
+                    for ticks, item in entries:
+                        self._place(ticks, item)
+
+            slot = self.current % self.levels[0]
+            entries, self.wheels[0][slot] = self.wheels[0][slot], []
+            expired.extend(item for _, item in entries)
+
+        self._count -= len(expired)
+        return expired
+
+    def _place(self, ticks, item):
+        # Уровень определяется старшими "разрядами" номера тика: таймер
+        # кладется на младший уровень, в пределах интервала которого он
+        # находится вместе с текущим тиком.
+        for level, size in enumerate(self.levels):
+            interval = self.spans[level] * size
+            last = level == len(self.levels) - 1
+            if ticks // interval == self.current // interval or (
+                    last and ticks // self.spans[level] - self.current // self.spans[level] < size):
+                slot = (ticks // self.spans[level]) % size
+                self.wheels[level][slot].append((ticks, item))
+                return
+        raise ValueError('Таймер слишком далеко в будущем для колеса')
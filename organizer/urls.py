@@ -13,4 +13,6 @@ urlpatterns = [
         path('service_records/<int:pk>', RecordServiceDetail.as_view(), name='record-service-detail'),
         path('medpersona_service_records', RecordServiceMedPersonaList.as_view(), name='record-servier-medpersona-list'),
         path('medpersona_service_records/<int:pk>', RecordServiceMedPersonaDetail.as_view(), name='record-servier-medpersona-detail'),
+        path('bookings', BookingCreate.as_view(), name='booking-create'),
+        path('calendar', CalendarView.as_view(), name='calendar'),
 ]
@@ -1,8 +1,14 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.renderers import JSONRenderer
+from med.renderers import FastJSONRenderer
 from rest_framework.response import Response
-from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView, RetrieveAPIView
+from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView, RetrieveAPIView, CreateAPIView
 from rest_framework.parsers import JSONParser
+from rest_framework.views import APIView
 from rest_framework.status import *
 from medAppApi.license import *
 from med.models import Patient, Notes, Task
@@ -27,11 +33,25 @@ class NoteList(ListCreateAPIView):
     queryset = Notes.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = NoteSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
+    expand_query_param = 'expand'
 
     def list(self, request, *args, **kwargs):
         notes = Notes.objects.filter(user=request.user)
-        serializer = self.serializer_class(notes, many=True)
+        serializer_class = self.serializer_class
+
+        # ?expand=tasks: задачи всех заметок страницы загружаются одним
+        # дополнительным запросом вместо запроса TaskList на каждую заметку
+        if 'tasks' in request.query_params.get(self.expand_query_param, '').split(','):
+            notes = notes.prefetch_related(Prefetch('task_set', queryset=Task.objects.order_by('id')))
+            serializer_class = NoteWithTasksSerializer
+
+        page = self.paginate_queryset(notes)
+        if page is not None:
+            serializer = serializer_class(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = serializer_class(notes, many=True)
         return Response(serializer.data, status=HTTP_200_OK)
 
 
@@ -49,7 +69,7 @@ class NoteDetail(RetrieveUpdateDestroyAPIView):
     queryset = Notes.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = NoteSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     def retrieve(self, request, *args, **kwargs):
         notes = get_user_object(request, Notes.objects.all(), kwargs.get('pk', ''))
@@ -67,7 +87,7 @@ class NoteDetail(RetrieveUpdateDestroyAPIView):
 class TaskList(ListCreateAPIView):
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = TaskSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     def list(self, request, *args, **kwargs):
         notes = get_user_notes(request, kwargs.get('note_pk', ''))
@@ -78,6 +98,11 @@ class TaskList(ListCreateAPIView):
 
         note = notes[0]
         task = Task.objects.filter(note=note)
+        page = self.paginate_queryset(task)
+        if page is not None:
+            serializer = self.serializer_class(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
         serializer = self.serializer_class(task, many=True)
         return Response(serializer.data, status=HTTP_200_OK)
 
@@ -94,12 +119,69 @@ class TaskList(ListCreateAPIView):
         serializer.save()
         return Response(serializer.data, status=HTTP_201_CREATED)
 
+    def patch(self, request, *args, **kwargs):
+        """
+        Пакетное изменение задач заметки: [{"id": 1, "status": "Done"}, ...].
+        Задачи выбираются одним запросом с проверкой владельца заметки и
+        сохраняются одним bulk_update. Для каждого элемента возвращается
+        результат: updated с задачей или not_found.
+        """
+        if not Notes.objects.filter(pk=kwargs['note_pk'], user=request.user).exists():
+            return Response(status=HTTP_404_NOT_FOUND)
+
+        serializer = TaskBulkUpdateSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+
+        with transaction.atomic():
+            tasks = Task.objects.select_for_update(of=('self',)).filter(
+                note_id=kwargs['note_pk'],
+                note__user=request.user,
+                pk__in=[item['id'] for item in items],
+            ).in_bulk()
+
+            fields = set()
+            for item in items:
+                task = tasks.get(item['id'])
+                if task is None:
+                    continue
+                for field, value in item.items():
+                    if field != 'id':
+                        setattr(task, field, value)
+                        fields.add(field)
+            if tasks:
+                Task.objects.bulk_update(tasks.values(), sorted(fields))
+
+        results = [
+            {'id': item['id'], 'result': 'updated', 'task': self.serializer_class(tasks[item['id']]).data}
+            if item['id'] in tasks else {'id': item['id'], 'result': 'not_found'}
+            for item in items
+        ]
+        return Response(results, status=HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        """ Пакетное удаление задач заметки: {"ids": [1, 2, ...]}. """
+        if not Notes.objects.filter(pk=kwargs['note_pk'], user=request.user).exists():
+            return Response(status=HTTP_404_NOT_FOUND)
+
+        serializer = TaskBulkDeleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+
+        with transaction.atomic():
+            tasks = Task.objects.filter(note_id=kwargs['note_pk'], note__user=request.user, pk__in=ids)
+            found = set(tasks.select_for_update(of=('self',)).values_list('pk', flat=True))
+            tasks.delete()
+
+        results = [{'id': pk, 'result': 'deleted' if pk in found else 'not_found'} for pk in ids]
+        return Response(results, status=HTTP_200_OK)
+
 
 class TaskDetail(RetrieveUpdateDestroyAPIView):
     queryset = Task.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = TaskSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     def retrieve(self, request, *args, **kwargs):
         tasks = get_user_tasks(request, kwargs.get('task_pk', ''))
@@ -150,7 +232,7 @@ class RecordList(ListCreateAPIView):
     queryset = Record.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = RecordSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
     filterset_class = RecordFilter
 
     def get_queryset(self):
@@ -182,7 +264,7 @@ class RecordDetail(RetrieveUpdateDestroyAPIView):
     queryset = Record.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = RecordSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     def retrieve(self, request, *args, **kwargs):
         if request.user.role == 'Patient':
@@ -202,7 +284,9 @@ class RecordDetail(RetrieveUpdateDestroyAPIView):
             return Response(status=HTTP_403_FORBIDDEN)
 
         try:
-            record = Record.objects.get(pk=kwargs['pk'])
+            # Связи нужны событию об изменении записи (organizer.signal)
+            record = Record.objects.select_related(
+                'patient', 'record_service__record_service_medpersona__medpersona').get(pk=kwargs['pk'])
         except Record.DoesNotExist:
             return Response(status=HTTP_404_NOT_FOUND)
 
@@ -230,7 +314,7 @@ class RecordServiceList(ListCreateAPIView):
     queryset = RecordService.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = RecordServiceSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
     filterset_class = RecordServiceFilter
 
     def get_queryset(self):
@@ -255,14 +339,14 @@ class RecordServiceDetail(RetrieveAPIView):
     queryset = RecordService.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = RecordServiceSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
 
 class RecordServiceMedPersonaList(ListCreateAPIView):
     queryset = RecordServiceMedPersona.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = RecordMedPersonaSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     def get_queryset(self):
         if self.request.user.role == 'Patient':
@@ -286,7 +370,7 @@ class RecordServiceMedPersonaDetail(RetrieveAPIView):
     queryset = RecordServiceMedPersona.objects.all()
     permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
     serializer_class = RecordMedPersonaSerializer
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     # def update(self, request, *args, **kwargs):
     #     if request.user.role is not 'Doctor':
@@ -305,3 +389,69 @@ class RecordServiceMedPersonaDetail(RetrieveAPIView):
     #     return Response(serializer.data, status=HTTP_200_OK)
 
 
+class BookingCreate(CreateAPIView):
+    permission_classes = [IsAuthenticated, IsUserPatient]
+    serializer_class = BookingSerializer
+    renderer_classes = [FastJSONRenderer]
+
+    def create(self, request, *args, **kwargs):
+        try:
+            patient = Patient.objects.get(user_id=request.user.id)
+        except Patient.DoesNotExist:
+            return Response(status=HTTP_404_NOT_FOUND)
+
+        # Можно передать одну запись или список записей
+        many = isinstance(request.data, list)
+        serializer = self.serializer_class(data=request.data, many=many, context={'patient': patient})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        return Response(serializer.data, status=HTTP_201_CREATED)
+
+
+class CalendarView(APIView):
+    permission_classes = [IsAuthenticated, IsUserPatient|IsUserMedic]
+    renderer_classes = [FastJSONRenderer]
+
+    def get(self, request, *args, **kwargs):
+        serializer = CalendarQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        if request.user.role == 'Patient':
+            records = Record.objects.filter(patient__user_id=request.user.id)
+        else:
+            records = Record.objects.filter(
+                record_service__record_service_medpersona__medpersona__user_id=request.user.id)
+
+        # Записи, услуги и медперсоны загружаются одним запросом
+        records = records.filter(
+            date_start__lt=params['to'],
+            date_end__gt=params['from'],
+        ).select_related(
+            'record_service__service',
+            'record_service__record_service_medpersona__medpersona__user',
+        ).order_by('date_start', 'id')
+
+        return Response(group_by_week(records), status=HTTP_200_OK)
+
+
+def group_by_week(records):
+    """
+    Раскладывает записи, отсортированные по началу, по неделям и дням:
+    [{'week': понедельник, 'days': [{'date': день, 'records': [...]}]}].
+    Дни считаются в часовом поясе TIME_ZONE.
+    """
+    records = list(records)
+    weeks = []
+    for record, data in zip(records, CalendarRecordSerializer(records, many=True).data):
+        day = timezone.localtime(record.date_start).date()
+        week = day - timedelta(days=day.weekday())
+
+        if not weeks or weeks[-1]['week'] != week:
+            weeks.append({'week': week, 'days': []})
+        days = weeks[-1]['days']
+        if not days or days[-1]['date'] != day:
+            days.append({'date': day, 'records': []})
+        days[-1]['records'].append(data)
+    return weeks
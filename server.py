@@ -1,6 +1,7 @@
+from django.conf import settings
 from waitress import serve
 
 from medAppApi.wsgi import application
 
 if __name__ == '__main__':
-    serve(application, port='8000')
\ No newline at end of file
+    serve(application, port='8000', threads=settings.SERVER_THREADS)
\ No newline at end of file